@@ -0,0 +1,105 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from backend.histogram import Histogram
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted: `status` is 429 (wait queue full) or 503 (waited too long)."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Lets at most `slots` requests use the models at once. Others wait in a FIFO queue of at
+    most `max_queue` requests, for at most `max_wait` seconds each; beyond that they are
+    turned away right away with a Retry-After estimated from recent service times.
+    """
+
+    def __init__(self, slots=2, max_queue=16, max_wait=10):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queue_wait = Histogram()
+        self.service_time = Histogram()
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until a slot is likely free for a new request: the queue ahead of it, drained `slots` at a time."""
+        mean = self.service_time.snapshot()['mean'] or 1
+        return max(1, math.ceil(mean * (len(self._waiters) + 1) / self.slots))
+
+    def acquire(self):
+        """Takes a slot, waiting for one if needed. Raises Overloaded if the request is not admitted."""
+        queued = time.monotonic()
+        with self._lock:
+            if self.active < self.slots and not self._waiters:
+                self.active += 1
+                self.admitted += 1
+                self.queue_wait.observe(0)
+                return
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded(f"Too many requests waiting ({self.max_queue}), retry later.", 429, self.retry_after())
+            turn = threading.Event()
+            self._waiters.append(turn)
+        turn.wait(self.max_wait)
+        with self._lock:
+            # release() hands the slot over by setting the event, possibly right as the wait timed out
+            if not turn.is_set():
+                self._waiters.remove(turn)
+                self.timed_out += 1
+                raise Overloaded(f"No inference slot freed up within {self.max_wait}s, retry later.", 503, self.retry_after())
+            self.admitted += 1
+        self.queue_wait.observe(time.monotonic() - queued)
+
+    def release(self, service_time=None):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()  # the slot goes to the oldest waiter
+            else:
+                self.active -= 1
+        if service_time is not None:
+            self.service_time.observe(service_time)
+
+    def run(self, function, *args, **kwargs):
+        """Calls `function` holding a slot. Raises Overloaded if the request is not admitted."""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+            "service_seconds": self.service_time.snapshot()
+        }
+
+
+def from_env():
+    """Builds the controller from CHATBRAIN_INFERENCE_SLOTS, CHATBRAIN_ADMISSION_QUEUE and CHATBRAIN_ADMISSION_WAIT (seconds)."""
+    return AdmissionController(
+        slots=int(os.getenv("CHATBRAIN_INFERENCE_SLOTS", 2)),
+        max_queue=int(os.getenv("CHATBRAIN_ADMISSION_QUEUE", 16)),
+        max_wait=float(os.getenv("CHATBRAIN_ADMISSION_WAIT", 10))
+    )
@@ -1,36 +1,139 @@
-from flask import Flask, request
+from flask import Flask, Response, g, request, stream_with_context
+import json
 if __name__ == '__main__':
     import utilities
+    import jobs
+    import admission
+    import models
 else:
     from . import utilities
+    from . import jobs
+    from . import admission
+    from . import models
 from flask_cors import CORS
-from ultralytics import YOLO
-from easyocr import Reader
+import os
+from backend.vision import result_cache
+from backend.vision import batching
+from backend.vision import detector
+from backend.vision import ocr_pool
+from backend import metrics
+from backend import profiling
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Load the vision model once when the API starts
+def loadReader():
+    from easyocr import Reader
+    return Reader(['fr'], gpu=False)  # use french to handle accents
+
+# The models are loaded once, on first use (see /ready), or right away with CHATBRAIN_WARMUP=1
+model_registry = models.ModelRegistry()
+# Vision model on the backend picked by CHATBRAIN_DETECTOR_BACKEND
 model_path = "backend/vision/best.pt"
-vision_model = YOLO(model_path)
-reader = Reader(['fr'], gpu=False)  # use french to handle accents
+vision_model = model_registry.add("detector", detector.from_env(model_path))
+# Concurrent requests share batched forward passes of the model
+batched_model = batching.from_env(vision_model)
+# CHATBRAIN_OCR_WORKERS > 0 reads on a pool of processes, each loading its own reader
+reader = ocr_pool.from_env(['fr']) or model_registry.add("reader", models.LazyModel(loadReader))
+# Tokenizer of the LLM price checks, unless they only estimate the token counts (CHATBRAIN_TOKEN_COUNT=estimate)
+if utilities.llm_analysis.TOKEN_COUNT_MODE != "estimate":
+    model_registry.add("tokenizer", models.LazyModel(utilities.llm_analysis.loadTokenizer))
+image_options = utilities.imageOptionsFromEnv()
+# Detection + OCR results of already seen screenshots
+vision_cache = result_cache.from_env(model_path, ['fr'], utilities.cacheSettings(vision_model, image_options))
+# Worker pool for the asynchronous /metadata/jobs mode
+job_queue = jobs.from_env(model_path, image_options)
+# Bounds the /metadata requests using the models at once, and how many may wait for them
+inference_admission = admission.from_env()
+# Profiles requests sent with "X-Chatbrain-Profile: 1", or a sample of them, when CHATBRAIN_PROFILING=1
+profiler = profiling.from_env()
+if os.getenv("CHATBRAIN_WARMUP", "0") == "1":
+    model_registry.warm_up(background=True)
+
+
+@app.before_request
+def start_request_metrics():
+    metrics.begin_request()
+    g.profile = None
+    if request.path in ('/metadata', '/llm', '/llm/stream') and profiler.wanted(request.headers.get('X-Chatbrain-Profile')):
+        g.profile = profiler.start(request.path)
+
+@app.after_request
+def record_request_metrics(response):
+    seconds, stages = metrics.end_request(request.url_rule.rule if request.url_rule else "unmatched")
+    if g.get('profile') is not None:
+        # a streamed response is only profiled until its first byte
+        summary = g.profile.stop(method=request.method, path=request.path, status=response.status_code, stages=stages)
+        response.headers['X-Chatbrain-Profile-Id'] = summary['id']
+    if seconds is not None:
+        metrics.log_event("request", method=request.method, path=request.path, status=response.status_code,
+                          seconds=round(seconds, 6), stages=stages)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Stage and request latency histograms, in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
+@app.route('/ready', methods=['GET'])
+def get_readiness():
+    """Which models are loaded: 200 once all of them are, 503 before."""
+    status = model_registry.status()
+    return status, 200 if status["ready"] else 503
 
 # Basic route
 @app.route('/llm', methods=['POST'])
 def get_llm_analysis():
-    print(f"Received request: {request}")
     data = request.json
     if not data or 'conversation' not in data or 'users' not in data:
         raise Exception("Missing required parameters: conversation and users")
     conversation = data['conversation']
     users = data['users']
-    json, response = utilities.getConversationAnalysis(conversation, users)
-    if response.choices[0].message.refusal != None:
-        print("Model refused to answer for the following reason:")
-        print(response.choices[0].message.refusal)
-        return None
-    return json
+    encoding = utilities.encodeConversation(conversation, users, data.get('drop_low_information'))
+    json, response = utilities.getConversationAnalysis(conversation, users, encoding)
+    if json is None:
+        if response is not None:
+            return {"error": f"Model refused to answer: {response.choices[0].message.refusal}"}, 422
+        return {"error": "Conversation too long for LLM analysis"}, 413
+    return json, 200, utilities.encodingHeaders(encoding)
+
+@app.route('/llm/stream', methods=['POST'])
+def stream_llm_analysis():
+    """Server-sent-events variant of /llm: forwards tokens and completed analysis fields as they are generated."""
+    data = request.json
+    if not data or 'conversation' not in data or 'users' not in data:
+        return {"error": "Missing required parameters: conversation and users"}, 400
+    encoding = utilities.encodeConversation(data['conversation'], data['users'], data.get('drop_low_information'))
+    events = utilities.getConversationAnalysisStream(data['conversation'], data['users'], encoding)
+
+    def generate():
+        try:
+            for event, payload in events:
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', **utilities.encodingHeaders(encoding)})
+
+@app.route('/llm/client', methods=['GET'])
+def get_llm_client_stats():
+    """Calls, retries, failures and calls in flight of the DeepSeek client."""
+    return utilities.llm_analysis.getClient().stats(), 200
+
+@app.route('/usage', methods=['GET'])
+def get_llm_usage():
+    """
+    LLM usage from the ledger, per `window` seconds (default 3600) between the `since` and `until`
+    timestamps (default: the last 24 hours): calls, cache hits, tokens, spend and latency p50/p95.
+    `call` restricts it to one kind of call (analysis, stream, synthesis, chunked).
+    """
+    window = request.args.get('window', 3600, type=float)
+    if window <= 0:
+        return {"error": "window must be positive"}, 400
+    return utilities.llm_analysis.ledger.aggregate(window, request.args.get('since', type=float),
+                                                   request.args.get('until', type=float),
+                                                   request.args.get('call')), 200
 
 @app.route('/metadata', methods=['POST'])
 def get_metadata_analysis():
@@ -45,7 +148,8 @@ def get_metadata_analysis():
             metadata, conversation = utilities.getTextMetadata(files)
             img_results = None
         elif fileType == 'image':
-            metadata, conversation, img_results = utilities.getImageMetadata(files, vision_model, reader)
+            metadata, conversation, img_results = inference_admission.run(
+                utilities.getImageMetadata, files, batched_model, reader, vision_cache, **image_options)
         elif fileType == 'audio':
             return {"error": "Audio not implemented"}, 501
         else:
@@ -56,9 +160,55 @@ def get_metadata_analysis():
             "img_results": img_results
         }, 200
 
+    except admission.Overloaded as e:
+        return {"error": str(e)}, e.status, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         return {"error": str(e)}, 500
 
+@app.route('/metadata/cache', methods=['GET'])
+def get_metadata_cache_stats():
+    return vision_cache.stats(), 200
+
+@app.route('/metadata/admission', methods=['GET'])
+def get_metadata_admission_stats():
+    return inference_admission.stats(), 200
+
+@app.route('/metadata/batching', methods=['GET'])
+def get_metadata_batching_stats():
+    return batched_model.stats(), 200
+
+@app.route('/metadata/jobs', methods=['POST'])
+def submit_metadata_job():
+    """Queues the uploaded files for analysis and returns a job id right away."""
+    files = request.files.getlist('files')
+    if not files:
+        return {"error": "No files uploaded"}, 400
+    correctInput, fileType = checkOnReceive(request)
+    if not correctInput:
+        return {"error": "Invalid file upload"}, 400
+    if fileType == 'audio':
+        return {"error": "Audio not implemented"}, 501
+    if fileType not in ('text', 'image'):
+        return {"error": "Unsupported file type"}, 400
+    try:
+        job_id = job_queue.submit(fileType, [file.read() for file in files])
+    except jobs.QueueFull as e:
+        return {"error": str(e)}, 429
+    return {"job_id": job_id, "status": "queued"}, 202
+
+@app.route('/metadata/jobs/<job_id>', methods=['GET'])
+def get_metadata_job(job_id):
+    """Returns the state of a job. `?wait=<seconds>` long-polls until the job is done (at most 60s)."""
+    wait = min(request.args.get('wait', 0, type=float), 60)
+    job = job_queue.get(job_id, wait)
+    if job is None:
+        return {"error": f"Unknown job: {job_id}"}, 404
+    return job, 200
+
+@app.route('/metadata/jobs', methods=['GET'])
+def get_metadata_jobs_stats():
+    return job_queue.stats(), 200
+
 def checkOnReceive(request):
     '''Detects the type of files in the provided list of files from an HTTP POST.'''
     files = request.files.getlist('files')
@@ -0,0 +1,42 @@
+"""
+Production server: gunicorn loads the API (YOLO model and OCR reader included) once in
+the master process, then forks the workers, which share the weight pages copy-on-write.
+
+    gunicorn -c api/gunicorn.conf.py    (from the repository root)
+
+Configured with CHATBRAIN_BIND (default 0.0.0.0:5000), CHATBRAIN_WORKERS (default 2),
+CHATBRAIN_THREADS (request threads per worker, default 4) and CHATBRAIN_TORCH_THREADS
+(torch threads per worker, default: the cores divided between the workers).
+The /metadata/jobs store is shared by the workers, and only one of them runs the job pool (api/jobs.py).
+"""
+import gc
+import os
+
+wsgi_app = "api.api:app"
+bind = os.getenv("CHATBRAIN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("CHATBRAIN_WORKERS", 2))
+worker_class = "gthread"
+threads = int(os.getenv("CHATBRAIN_THREADS", 4))
+timeout = 120
+# import the app, and so load the models, before forking
+preload_app = True
+
+# collections in the master would write to the header of every object, copying their pages in each worker
+gc.disable()
+
+def pre_fork(server, worker):
+    # the models are otherwise loaded on first use, by each worker
+    from api import api
+    api.model_registry.warm_up()
+    # objects allocated so far are never collected nor touched by the workers' collections
+    gc.freeze()
+
+def post_fork(server, worker):
+    gc.enable()
+    import cv2
+    import torch
+    # the master never ran inference, so the thread pools are created here, sized for one worker
+    torch_threads = int(os.getenv("CHATBRAIN_TORCH_THREADS", max(1, (os.cpu_count() or 1) // workers)))
+    torch.set_num_threads(torch_threads)
+    cv2.setNumThreads(torch_threads)
+    server.log.info(f"Worker {worker.pid} using {torch_threads} torch threads")
@@ -0,0 +1,334 @@
+import io
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+if __package__:
+    from . import utilities
+else:
+    import utilities
+from backend import metrics
+from backend.histogram import Histogram
+from backend.vision import result_cache
+from backend.vision import detector
+
+# Models owned by each worker process, loaded once by _init_worker
+_worker_model = None
+_worker_reader = None
+_worker_cache = None
+_worker_store = None
+_worker_options = {}
+
+def _init_worker(model_path, languages, options, store_path):
+    global _worker_model, _worker_reader, _worker_cache, _worker_store, _worker_options
+    from easyocr import Reader
+    _worker_model = detector.from_env(model_path)
+    _worker_model.load()
+    _worker_reader = Reader(languages, gpu=False)
+    # the memory tier is per process, the disk tier is shared with the API process
+    _worker_cache = result_cache.from_env(model_path, languages, utilities.cacheSettings(_worker_model, options))
+    _worker_store = JobStore(store_path)
+    _worker_options = options
+
+def _run_job(job_id, fileType, payloads):
+    """Runs one metadata job inside a worker process. `payloads` are the raw bytes of the uploaded files."""
+    started = time.time()
+    _worker_store.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (started, job_id))
+    files = [io.BytesIO(payload) for payload in payloads]
+    if fileType == 'text':
+        metadata, conversation = utilities.getTextMetadata(files)
+        img_results = None
+    else:
+        metadata, conversation, img_results = utilities.getImageMetadata(files, _worker_model, _worker_reader, _worker_cache, **_worker_options)
+    result = {
+        "metadata": metadata,
+        "conversation": conversation,
+        "img_results": img_results
+    }
+    return result, started, time.time()
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore:
+    """
+    SQLite table of the jobs and their results, shared by all the API processes (the gunicorn
+    workers) and the job workers, so that a job can be polled from any of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._initialized and os.path.dirname(self.path):
+            # sqlite creates the file, but not its directory
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        if not self._initialized:
+            with self._lock:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        status TEXT NOT NULL,
+                        file_type TEXT NOT NULL,
+                        files INTEGER NOT NULL,
+                        payloads BLOB,
+                        dispatched INTEGER NOT NULL DEFAULT 0,
+                        submitted REAL NOT NULL,
+                        started REAL,
+                        finished REAL,
+                        result TEXT,
+                        error TEXT
+                    )""")
+                connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+                connection.execute("CREATE TABLE IF NOT EXISTS job_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                connection.commit()
+                self._initialized = True
+        return connection
+
+    def execute(self, query, parameters=()):
+        """Runs one statement in its own transaction and returns its rows."""
+        connection = self._connect()
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def increment(self, name):
+        self.execute("INSERT INTO job_counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,))
+
+    def counters(self):
+        return {row['name']: row['value'] for row in self.execute("SELECT name, value FROM job_counters")}
+
+    def queue(self, job_id, fileType, payloads, max_pending, job_ttl):
+        """
+        Adds a queued job, unless `max_pending` jobs are already queued or running (returns False).
+        Jobs finished more than `job_ttl` seconds ago are deleted on the way.
+        """
+        now = time.time()
+        connection = self._connect()
+        connection.isolation_level = None
+        try:
+            # the count and the insert are one transaction across processes
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (now - job_ttl,))
+            pending = connection.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if pending >= max_pending:
+                connection.execute("COMMIT")
+                return False
+            connection.execute("INSERT INTO jobs (id, status, file_type, files, payloads, submitted) VALUES (?, 'queued', ?, ?, ?, ?)",
+                               (job_id, fileType, len(payloads), pickle.dumps(payloads), now))
+            connection.execute("COMMIT")
+            return True
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+
+class JobQueue:
+    """
+    Runs metadata analyses on a pool of worker processes, each holding its own
+    YOLO model and OCR reader. Jobs are identified by a uuid and kept for
+    `job_ttl` seconds after they finish so that clients can poll for them.
+
+    Jobs live in a JobStore, so that under gunicorn any worker can queue or poll them. Only
+    one API process runs the pool: the one holding the lock of `<store_path>.lock`. Its
+    dispatcher thread sends the queued jobs to the pool, and another process takes over
+    when it dies.
+    """
+
+    def __init__(self, model_path, languages=['fr'], options={}, workers=2, max_pending=32, job_ttl=600,
+                 store_path=".cache/jobs.sqlite3", poll_interval=0.2):
+        self.model_path = model_path
+        self.languages = languages
+        self.options = options  # keyword arguments of utilities.getImageMetadata
+        self.workers = workers
+        self.max_pending = max_pending
+        self.job_ttl = job_ttl
+        self.poll_interval = poll_interval
+        self.store = JobStore(store_path)
+        self.runs_pool = False
+        self._executor = None
+        self._pid = None
+        self._dispatcher_pid = None
+        self._runner_lock = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # started lazily so the pool is only forked by the process that runs the jobs (called holding the lock)
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.model_path, self.languages, self.options, self.store.path)
+            )
+            self._pid = os.getpid()
+        return self._executor
+
+    def _discard_executor(self, executor):
+        """
+        Drops a pool broken by the death of one of its workers (e.g. killed for memory): its
+        jobs all fail with BrokenProcessPool, and the next job starts a new pool.
+        """
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False)
+
+    def _start_dispatcher(self):
+        """The dispatcher thread, started on first use (in each process, as it doesn't survive a fork)."""
+        with self._lock:
+            if self._dispatcher_pid != os.getpid():
+                self._dispatcher_pid = os.getpid()
+                self.runs_pool = False
+                self._wake = threading.Event()
+                threading.Thread(target=self._dispatch, daemon=True, name="job-dispatcher").start()
+
+    def _acquire_runner_lock(self):
+        """Blocks until this process holds the lock of the pool's runner, held until it exits."""
+        try:
+            import fcntl
+        except ImportError:
+            # without fcntl (Windows), the API runs as a single process
+            return None
+        lock_file = open(self.store.path + ".lock", "a")
+        # POSIX locks aren't inherited by the pool's processes: the lock is released with this process
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _dispatch(self):
+        self.store.counters()  # creates the store, and its directory
+        self._runner_lock = self._acquire_runner_lock()
+        self.runs_pool = True
+        # jobs running on the pool of a previous runner died with it; those it had not started are sent again
+        self.store.execute("UPDATE jobs SET status = 'failed', finished = ?, error = ?, payloads = NULL WHERE status = 'running'",
+                           (time.time(), "The API process running the job stopped"))
+        self.store.execute("UPDATE jobs SET dispatched = 0 WHERE status = 'queued'")
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                for row in self.store.execute("SELECT id, file_type, payloads FROM jobs WHERE status = 'queued' AND dispatched = 0 ORDER BY submitted"):
+                    self._run(row['id'], row['file_type'], pickle.loads(row['payloads']))
+            except sqlite3.Error as e:
+                metrics.logger.warning(f"Job dispatcher: could not read the queued jobs: {e}")
+
+    def _run(self, job_id, fileType, payloads):
+        self.store.execute("UPDATE jobs SET dispatched = 1 WHERE id = ?", (job_id,))
+        with self._lock:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(_run_job, job_id, fileType, payloads)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                executor = self._get_executor()
+                future = executor.submit(_run_job, job_id, fileType, payloads)
+        future.add_done_callback(lambda f: self._on_done(job_id, executor, f))
+
+    def _on_done(self, job_id, executor, future):
+        error = future.exception()
+        if error is None:
+            result, started, finished = future.result()
+            try:
+                self.store.execute("UPDATE jobs SET status = 'done', result = ?, started = ?, finished = ?, payloads = NULL WHERE id = ?",
+                                   (json.dumps(result), started, finished, job_id))
+                self.store.increment("completed")
+                return
+            except (TypeError, ValueError) as e:
+                error = e
+        if isinstance(error, BrokenProcessPool):
+            with self._lock:
+                self._discard_executor(executor)
+            message = "The worker process running the job died (out of memory?)"
+        else:
+            message = str(error)
+        self.store.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ?, payloads = NULL WHERE id = ?",
+                           (message, time.time(), job_id))
+        self.store.increment("failed")
+
+    def submit(self, fileType, payloads):
+        """Queues a job and returns its id. Raises QueueFull when `max_pending` jobs are already waiting or running."""
+        self._start_dispatcher()
+        job_id = uuid.uuid4().hex
+        if not self.store.queue(job_id, fileType, payloads, self.max_pending, self.job_ttl):
+            self.store.increment("rejected")
+            raise QueueFull(f"Job queue is full ({self.max_pending} pending jobs), retry later.")
+        # picked up right away when this process runs the pool, on the runner's next poll otherwise
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id, wait=0):
+        """
+        Returns the state of a job, or None if it is unknown.
+        With `wait` > 0, blocks up to `wait` seconds for the job to finish (long-polling).
+        """
+        self._start_dispatcher()
+        end = time.monotonic() + wait
+        while True:
+            rows = self.store.execute("SELECT status, submitted, started, finished, result, error FROM jobs WHERE id = ?", (job_id,))
+            if not rows:
+                return None
+            job = rows[0]
+            if job['status'] in ("done", "failed") or time.monotonic() >= end:
+                break
+            time.sleep(min(self.poll_interval, end - time.monotonic()))
+        if job['status'] == "failed":
+            return {"job_id": job_id, "status": "failed", "error": job['error']}
+        if job['status'] != "done":
+            return {"job_id": job_id, "status": job['status'], "waited": round(time.time() - job['submitted'], 3)}
+        timings = {
+            "queued": round(job['started'] - job['submitted'], 3),
+            "run": round(job['finished'] - job['started'], 3),
+            "total": round(job['finished'] - job['submitted'], 3)
+        }
+        return {"job_id": job_id, "status": "done", "result": json.loads(job['result']), "timings": timings}
+
+    def stats(self):
+        """Queue depth and timings, to scale the number of workers on the backlog."""
+        self._start_dispatcher()
+        statuses = {row['status']: row['count'] for row in self.store.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")}
+        counters = self.store.counters()
+        # timings of the finished jobs still kept, whichever process ran them
+        queue_wait, run_time = Histogram(), Histogram()
+        for row in self.store.execute("SELECT submitted, started, finished FROM jobs WHERE status = 'done'"):
+            queue_wait.observe(row['started'] - row['submitted'])
+            run_time.observe(row['finished'] - row['started'])
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "runs_pool": self.runs_pool,
+            "queued": statuses.get("queued", 0),
+            "running": statuses.get("running", 0),
+            "completed": counters.get("completed", 0),
+            "failed": counters.get("failed", 0),
+            "rejected": counters.get("rejected", 0),
+            "queue_wait_seconds": queue_wait.snapshot(),
+            "run_seconds": run_time.snapshot()
+        }
+
+
+def from_env(model_path, options={}):
+    """Builds the job queue from the CHATBRAIN_JOB_* environment variables."""
+    return JobQueue(
+        model_path,
+        options=options,
+        workers=int(os.getenv("CHATBRAIN_JOB_WORKERS", 2)),
+        max_pending=int(os.getenv("CHATBRAIN_JOB_QUEUE_SIZE", 32)),
+        job_ttl=int(os.getenv("CHATBRAIN_JOB_TTL", 600)),
+        store_path=os.getenv("CHATBRAIN_JOB_STORE", ".cache/jobs.sqlite3")
+    )
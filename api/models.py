@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+class LazyModel:
+    """Stands in for the model built by `loader`, which is only called on first use (an attribute access or a call)."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                start = time.perf_counter()
+                self._model = self._loader()
+                self.load_seconds = time.perf_counter() - start
+        return self._model
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+class ModelRegistry:
+    """The models of the API process, loaded on first use, by warm_up(), and reported by status()."""
+
+    def __init__(self):
+        self.models = {}
+        self.errors = {}
+
+    def add(self, name, model):
+        """Registers a model with load(), `loaded` and `load_seconds` (a LazyModel or a detector.Detector)."""
+        self.models[name] = model
+        return model
+
+    def ready(self):
+        return all(model.loaded for model in self.models.values())
+
+    def status(self):
+        return {
+            "ready": self.ready(),
+            "models": {
+                name: {"loaded": model.loaded, "load_seconds": model.load_seconds, "error": self.errors.get(name)}
+                for name, model in self.models.items()
+            }
+        }
+
+    def warm_up(self, background=False):
+        """Loads every model now, or in a background thread. Load errors are reported by status()."""
+        def load_all():
+            for name, model in self.models.items():
+                try:
+                    model.load()
+                    self.errors.pop(name, None)
+                except Exception as e:
+                    self.errors[name] = str(e)
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, daemon=True, name="model-warm-up")
+        thread.start()
+        return thread
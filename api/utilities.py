@@ -6,24 +6,126 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../bac
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../backend/llm'))
 
 from backend import chat_shrinker
+from backend import conversation_encoder
 from backend import local_analysis
+from backend import metrics
 from backend.llm import llm_analysis
+from backend.llm import chunked_analysis
+from backend.llm import json_stream
 from backend.vision import classifier
 from backend.vision import ocr
+from backend.vision import stitching
+from backend.vision import pipeline
+from backend.vision import ocr_pool
+import io
 import numpy as np
 import cv2
 from PIL import Image
 
-def getConversationAnalysis(conversation, users):
+# CHATBRAIN_LLM_ENCODE=0 sends conversations to the LLM as received, CHATBRAIN_LLM_DROP_LOW_INFO=1
+# also drops low-information messages by default (see conversation_encoder)
+ENCODE_CONVERSATIONS = os.getenv("CHATBRAIN_LLM_ENCODE", "1") == "1"
+DROP_LOW_INFORMATION = os.getenv("CHATBRAIN_LLM_DROP_LOW_INFO", "0") == "1"
+
+def encodeConversation(conversation, users, drop_low_information=None):
+    """
+    Encodes the conversation into fewer tokens for the LLM, and records its token counts
+    before and after. Returns None when encoding is disabled.
+    """
+    if not ENCODE_CONVERSATIONS:
+        return None
+    if drop_low_information is None:
+        drop_low_information = DROP_LOW_INFORMATION
+    with metrics.timed("conversation_encoding"):
+        encoding = conversation_encoder.encode(conversation, users, drop_low_information)
+        encoding.input_tokens, encoding.output_tokens = llm_analysis.countTokens([conversation, encoding.conversation])
+    metrics.ENCODING_TOKENS.inc(encoding.input_tokens, "input")
+    metrics.ENCODING_TOKENS.inc(encoding.output_tokens, "encoded")
+    metrics.log_event("conversation_encoding", input_tokens=encoding.input_tokens, output_tokens=encoding.output_tokens,
+                      messages=encoding.messages, merged=encoding.merged, dropped=encoding.dropped)
+    return encoding
+
+def encodingHeaders(encoding):
+    if encoding is None:
+        return {}
+    return {"X-Chatbrain-Input-Tokens": str(encoding.input_tokens), "X-Chatbrain-Encoded-Tokens": str(encoding.output_tokens)}
+
+def getConversationAnalysis(conversation, users, encoding=None):
+    """
+    Returns the analysis JSON and the API response. Conversations over the price guard are
+    analyzed in windows (see chunked_analysis). The JSON is None if the model refused, or if
+    the conversation is too long even for the chunked analysis. With an `encoding`, its
+    encoded conversation is analyzed, and the JSON uses the real names.
+    """
+    if encoding is not None:
+        conversation, users = encoding.conversation, encoding.users
     json, response = llm_analysis.promptToJSON(conversation, 2000, users)
+    if json is None and response is None:
+        json, response = chunked_analysis.promptToJSONChunked(conversation, 2000, users)
+    if encoding is not None:
+        json = encoding.decode(json)
     return json, response
 
+def getConversationAnalysisStream(conversation, users, encoding=None):
+    """
+    Streams the LLM analysis as (event, data) pairs:
+    - ("token", {"delta": str}) for every chunk of the completion
+    - ("field", {"path": [...], "value": ...}) as soon as an analysis field is complete
+    - ("done", {"json": str}) with the whole completion at the end
+    Conversations over the price guard are analyzed in windows, whose combined analysis is
+    sent as fields and "done" once complete. With an `encoding`, fields and "done" use the
+    real names, while the tokens are the raw completion, with the aliases.
+    """
+    if encoding is not None:
+        conversation, users = encoding.conversation, encoding.users
+    deltas = llm_analysis.promptToStream(conversation, 2000, users)
+    if deltas is None:
+        return decodeEvents(chunkedEvents(conversation, users), encoding)
+
+    def events():
+        fields = json_stream.FieldStream()
+        content = ""
+        for delta in deltas:
+            content += delta
+            yield "token", {"delta": delta}
+            for path, value in fields.feed(delta):
+                yield "field", {"path": list(path), "value": value}
+        yield "done", {"json": content}
+
+    return decodeEvents(events(), encoding)
+
+def chunkedEvents(conversation, users):
+    json, _ = chunked_analysis.promptToJSONChunked(conversation, 2000, users)
+    if json is None:
+        raise RuntimeError("Conversation too long for LLM analysis")
+    for path, value in json_stream.FieldStream().feed(json):
+        yield "field", {"path": list(path), "value": value}
+    yield "done", {"json": json}
+
+def decodeEvents(events, encoding):
+    """Maps the aliases of the field and done events back to the real names."""
+    if encoding is None:
+        return events
+    def decoded():
+        for event, payload in events:
+            if event == "field":
+                payload = {"path": encoding.decode_value(payload["path"]), "value": encoding.decode_value(payload["value"])}
+            elif event == "done":
+                payload = {"json": encoding.decode(payload["json"])}
+            yield event, payload
+    return decoded()
+
 # Text analysis
 
 def getTextMetadata(input_files):
-    string = fileToText(input_files[-1])
-    platform = local_analysis.detect_platform(string)
-    metadata, conversation = local_analysis.metadata_analysis(string, "text", platform)
+    with metrics.timed("upload_read"):
+        string = fileToText(input_files[-1])
+    with metrics.timed("platform_detection"):
+        platform = local_analysis.detect_platform(string)
+    with metrics.timed("metadata_analysis"):
+        metadata, conversation = local_analysis.metadata_analysis(string, "text", platform)
+    metrics.log_event("text_metadata", content={"metadata": metadata, "conversation": conversation},
+                      platform=platform, total_messages=metadata.get("total_messages"))
     return metadata, conversation
 
 def fileToText(file):
@@ -37,40 +139,172 @@ def fileToText(file):
 # Image analysis
 
 def convert_input_images(input_files):
-        converted_files = []
+        return [decode_input_image(file) for file in input_files]
+
+def decode_input_image(file):
+        return cv2.imdecode(np.frombuffer(read_input_bytes(file), np.uint8), cv2.IMREAD_COLOR)
+
+def read_input_bytes(file):
         # if input_files is a list of filepaths instead of file objects
-        if type(input_files[0]) == str:
-            for file in input_files:
-                image = cv2.imread(file)
-                converted_files.append(image)
-            return converted_files
-        for file in input_files:
-            file_content = file.read()
-            np_array = np.frombuffer(file_content, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-            converted_files.append(image)
-        return converted_files
-
-
-def getImageMetadata(input_files, vision_model, reader):
-    converted_files = convert_input_images(input_files)
-    img_results = classifier.getBoxesFromImages(converted_files, vision_model)
+        if type(file) == str:
+            with open(file, "rb") as f:
+                return f.read()
+        return file.read()
+
+# cv2.imdecode flags decoding at 1/2, 1/4 and 1/8 of the resolution (JPEG is decoded scaled, other formats are resized)
+REDUCED_DECODE_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def reductionFactor(width, height, detect_size=640, tiled=False):
+    """Largest decode reduction after which the detector still downscales the image (or its tiles) to `detect_size`."""
+    side = max(width, height)
+    if tiled and height > width * classifier.TILE_THRESHOLD:
+        side = width * classifier.TILE_ASPECT
+    for factor in sorted(REDUCED_DECODE_FLAGS, reverse=True):
+        if side / factor >= detect_size:
+            return factor
+    return 1
+
+def decode_reduced(content, detect_size=640, tiled=False):
+    """
+    Decodes a JPEG upload at the lowest resolution that loses nothing for detection.
+    The size is read from the header by PIL without decoding. Returns (image, factor).
+    Other formats are decoded whole before being resized, so a reduced decode followed by
+    the full one for OCR would cost twice the time: they are decoded at full resolution.
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            (width, height), format = image.size, image.format
+    except Exception:
+        format = None
+    if format != "JPEG":
+        return cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR), 1
+    factor = reductionFactor(width, height, detect_size, tiled)
+    flag = REDUCED_DECODE_FLAGS.get(factor, cv2.IMREAD_COLOR)
+    return cv2.imdecode(np.frombuffer(content, np.uint8), flag), factor
+
+
+def imageOptionsFromEnv():
+    """Options of getImageMetadata set by environment variables: CHATBRAIN_OCR_ENGINE, CHATBRAIN_TILED, CHATBRAIN_STITCH and CHATBRAIN_DECODE."""
+    return {
+        "decode": os.getenv("CHATBRAIN_DECODE", "full"),  # "full" or "reduced"
+        "ocr_engine": os.getenv("CHATBRAIN_OCR_ENGINE", "per_box"),  # one of ocr.OCR_ENGINES
+        "tiled": os.getenv("CHATBRAIN_TILED", "0") == "1",
+        "stitch": os.getenv("CHATBRAIN_STITCH", "1") == "1"
+    }
+
+def cacheSettings(vision_model, options):
+    """Everything besides the weights and languages that changes the cached image results."""
+    return (vision_model.name,) + tuple(f"{key}={value}" for key, value in sorted(options.items()))
+
+def decodeStage(input_files, cache, decode="full", detect_size=640, tiled=False):
+    """
+    Decodes the uploads one by one and looks their results up in the cache: yields (index,
+    image, key, cached result, encoded upload). With decode="reduced", the image is decoded
+    at a reduced resolution for detection, and the encoded upload is kept to decode the full
+    resolution for OCR (None when the image is already at full resolution).
+    """
+    for i, file in enumerate(input_files):
+        with metrics.timed("upload_read"):
+            content = read_input_bytes(file)
+        with metrics.timed("decode"):
+            if decode == "reduced":
+                cv_image, factor = decode_reduced(content, detect_size, tiled)
+            else:
+                cv_image, factor = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR), 1
+        key = cache.key(cv_image) if cache is not None else None
+        yield i, cv_image, key, cache.get(key) if cache is not None else None, content if factor > 1 else None
+
+def detectStage(batches, vision_model, tiled=False, stitch=True):
+    """
+    Detects the bubbles of the decoded frames that weren't cached, all frames already decoded
+    in one pass. A frame is held back until the next one is detected, to flag the bubbles
+    they share before either is read; frames with bubbles left to read are then decoded at
+    full resolution if they were reduced. Yields (index, image, key, result, cached).
+    """
+    def ready(frame):
+        i, cv_image, key, img_result, cached, _, content = frame
+        if content is not None and unreadBoxes(img_result):
+            with metrics.timed("decode"):
+                cv_image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+        return i, cv_image, key, img_result, cached
+
+    previous = None
+    for frames in batches:
+        missing = [cv_image for _, cv_image, _, cached, _ in frames if cached is None]
+        detected = iter(classifier.getBoxesFromImages(missing, vision_model, tiled=tiled) if missing else [])
+        for i, cv_image, key, cached, content in frames:
+            img_result = cached if cached is not None else next(detected)
+            current = [i, cv_image, key, img_result, cached is not None, None, content]
+            if stitch:
+                with metrics.timed("stitching"):
+                    current[5] = stitching.fingerprint_bubbles(cv_image, img_result['boxes'])
+                    if previous is not None:
+                        stitching.mark_overlap(previous[5], previous[3], current[5], img_result)
+            if previous is not None:
+                yield ready(previous)
+            previous = current
+    if previous is not None:
+        yield ready(previous)
+
+def unreadBoxes(img_result):
+    """The bubbles left to read: not read yet (their text isn't cached), and not already in the previous screenshot."""
+    return [box for box in img_result['boxes'] if not box.get('duplicate') and 'text' not in box]
+
+def cacheableResult(img_result):
+    """The result without its duplicate flags, which depend on the neighbouring screenshots of the request."""
+    return {**img_result, 'boxes': [{key: value for key, value in box.items() if key != 'duplicate'} for box in img_result['boxes']]}
+
+def getImageMetadata(input_files, vision_model, reader, cache=None, ocr_engine="per_box", tiled=False, stitch=True, decode="full"):
+    """
+    Decoding, detection and OCR run as a pipeline of threads with bounded queues: image n is
+    read while image n+1 is detected and image n+2 decoded, and a frame is dropped once read.
+    `reader` is an easyocr Reader, or an ocr_pool.OcrPool that reads the bubbles of all
+    images in parallel (frames are then dropped as soon as their crops are sent).
+    With decode="reduced", frames are decoded at a lower resolution for detection and at
+    full resolution only when they are about to be read.
+    """
+    img_results = [None] * len(input_files)
     conversation = ""
+    reading = []
+
+    detect_size = getattr(vision_model, "imgsz", 640)
+    frames = pipeline.threaded(decodeStage(input_files, cache, decode, detect_size, tiled), maxsize=2, batch=8, name="decode")
+    detected = pipeline.threaded(detectStage(frames, vision_model, tiled, stitch), maxsize=1, name="detect")
+    for i, cv_image, key, img_result, cached in detected:
+        img_results[i] = img_result
+        # cached results hold the texts read so far: only the bubbles never read before are read
+        unread = unreadBoxes(img_result)
+        if cached and not unread:
+            continue
+        # extract text from boxes, straight from the decoded BGR array
+        if isinstance(reader, ocr_pool.OcrPool):
+            reading.append((i, key, unread, reader.submit(cv_image, unread, ocr_engine)))
+        else:
+            if unread:
+                ocr.extract_text_from_boxes(cv_image, unread, reader, ocr_engine)
+            reading.append((i, key, unread, None))
+        cv_image = None
+
+    for i, key, unread, pending in reading:
+        img_result = img_results[i]
+        if pending is not None:
+            # the pool's workers don't report their timings, only the wait for them is measured
+            with metrics.timed("ocr_pool_wait"):
+                reader.collect(unread, pending)
+        # duplicates stay unread in the cache, to be read if an upload doesn't have them twice
+        if cache is not None:
+            cache.put(key, cacheableResult(img_result))
+    for img_result in img_results:
+        for box in img_result['boxes']:
+            box.setdefault('text', "")
 
-    for i, img_result in enumerate(img_results):
-        boxes = img_result['boxes']
-        # convert image to format readable by OCR
-        cv_image = converted_files[i]
-        pil_image = Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
-        # extract text from boxes
-        img_results[i]['boxes'] = ocr.extract_text_from_boxes(pil_image, boxes, reader)
-    
     contactName = findContactName(img_results)
     appended_results = addNames(img_results, contactName)
     metadata, conversation = compileAnalysis(appended_results)
 
-    print(f"final conversation: {conversation}")
-    print(f"final metadata: {metadata}")
+    metrics.log_event("image_metadata", content={"metadata": metadata, "conversation": conversation},
+                      images=len(img_results), total_messages=metadata["total_messages"],
+                      duplicates=sum(1 for result in img_results for box in result['boxes'] if box.get('duplicate')))
 
     return metadata, conversation, img_results
 
@@ -87,8 +321,11 @@ def compileAnalysis(appended_results):
 
     # Process each image result
     for img_result in appended_results:
-        text = "\n".join(box['text'] for box in img_result['boxes'] if box['cls'] != 2)
-        img_metadata, splitConv = local_analysis.metadata_analysis(text, "image", local_analysis.detect_platform(text))
+        text = "\n".join(box['text'] for box in img_result['boxes'] if box['cls'] != 2 and not box.get('duplicate'))
+        with metrics.timed("platform_detection"):
+            platform = local_analysis.detect_platform(text)
+        with metrics.timed("metadata_analysis"):
+            img_metadata, splitConv = local_analysis.metadata_analysis(text, "image", platform)
         
         # Add to conversation
         conv += splitConv
@@ -140,7 +377,7 @@ def buildConversation(appended_results):
     conversation = ""
     for img_result in appended_results:
         for box in img_result['boxes']:
-            if box['text'] != "" and box['cls'] != 2:
+            if box['text'] != "" and box['cls'] != 2 and not box.get('duplicate'):
                 conversation += box['text']
     return conversation
 
@@ -160,8 +397,10 @@ def findContactName(img_results):
     return contactName
 
 if __name__ == "__main__":
+    from backend.vision import detector
     # Load image
     model_path = "backend/vision/best.pt"
-    vision_model = classifier.YOLO(model_path)
+    vision_model = detector.from_env(model_path)
     image_paths = ["backend/vision/dataset/raw/why-did-alexa-stop-talking-to-me-she-seemed-nice-v0-xxaq456yw7ce1.webp"]
-    metadata = getImageMetadata(image_paths, vision_model)
\ No newline at end of file
+    from easyocr import Reader
+    metadata = getImageMetadata(image_paths, vision_model, Reader(['fr'], gpu=False))
\ No newline at end of file
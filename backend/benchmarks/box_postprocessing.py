@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the box post-processing of classifier.getBoxesFromImages:
+the previous per-box loop (legacy_process) against the array version
+(classifier.processBoxes), on synthetic detections from 10 to 5,000 boxes.
+Both outputs are checked to be identical.
+
+    python backend/benchmarks/box_postprocessing.py [--counts 10 100 1000 5000] [--legacy-max 2000]
+"""
+import argparse
+import time
+import numpy as np
+import dataset  # adds the repository root to sys.path
+from backend.vision import classifier
+
+def legacy_process(xywhn, conf, cls):
+    """The per-box loop of getBoxesFromImages before it was vectorized."""
+    raw_boxes = []
+    oneSided = True
+    leftMin = 1
+    leftMax = 0
+    for box_xywhn, box_conf, box_cls in zip(xywhn, conf, cls):
+        box_xywhn = [round(x, 5) for x in box_xywhn.tolist()]
+        box_conf = round(box_conf.item(), 2)
+        cls_id = int(box_cls.item())
+        x_center = box_xywhn[0]
+        leftEdge = x_center - box_xywhn[2]/2
+        if cls_id != 2:
+            leftMin = min(leftMin, leftEdge)
+            leftMax = max(leftMax, leftEdge)
+            if leftMax - leftMin > 0.1:
+                oneSided = False
+        raw_boxes.append({'xywhn': box_xywhn, 'conf': box_conf, 'cls': cls_id, 'posClass': 1 if x_center > 0.5 else 0})
+    raw_boxes.sort(key=lambda b: b['conf'], reverse=True)
+    final_boxes = []
+    for b in raw_boxes:
+        if not any(max(classifier.overlap_fractions(b, fb)) > 0.2 for fb in final_boxes):
+            final_boxes.append(b)
+    final_boxes.sort(key=lambda x: x['xywhn'][1])
+    return {'boxes': final_boxes, 'oneSided': oneSided}
+
+def synthetic_detections(n, seed=0):
+    """A long scrolling capture: n bubbles down the page, with ~10% near-duplicate detections."""
+    rng = np.random.default_rng(seed)
+    y = np.sort(rng.uniform(0, 1, n))
+    h = np.full(n, 0.6 / n)
+    x = np.where(rng.random(n) > 0.5, 0.7, 0.3) + rng.normal(0, 0.01, n)
+    w = rng.uniform(0.2, 0.5, n)
+    xywhn = np.column_stack([x, y, w, h])
+    duplicates = rng.random(n) < 0.1
+    xywhn[duplicates, 1] = np.roll(y, 1)[duplicates]
+    conf = rng.uniform(0.25, 0.99, n).astype(np.float32)
+    cls = rng.integers(0, 2, n).astype(np.float32)
+    return xywhn.astype(np.float32), conf, cls
+
+def timed(function, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 500, 1000, 2000, 5000])
+    parser.add_argument("--legacy-max", type=int, default=2000, help="skip the legacy loop above this many boxes")
+    args = parser.parse_args()
+    print(f"{'boxes':>6} {'kept':>6} {'vectorized':>12} {'legacy':>12} {'speedup':>8}")
+    for n in args.counts:
+        detections = synthetic_detections(n)
+        result, vectorized = timed(classifier.processBoxes, *detections)
+        if n <= args.legacy_max:
+            expected, legacy = timed(legacy_process, *detections, repeat=1)
+            assert result == expected, f"outputs differ for {n} boxes"
+            print(f"{n:>6} {len(result['boxes']):>6} {vectorized * 1000:>10.2f}ms {legacy * 1000:>10.2f}ms {legacy / vectorized:>7.1f}x")
+        else:
+            print(f"{n:>6} {len(result['boxes']):>6} {vectorized * 1000:>10.2f}ms {'skipped':>12}")
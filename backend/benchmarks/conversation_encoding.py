@@ -0,0 +1,76 @@
+"""
+Token savings of the conversation encoder on the /llm path: for each conversation, the
+tokens before and after conversation_encoder.encode, with and without dropping the
+low-information messages, and the encoding time.
+
+    python backend/benchmarks/conversation_encoding.py [--texts 'chats/*.txt'] [--estimate]
+
+Each --texts file is one conversation ("Name: message" lines or a WhatsApp export, whose
+users are detected); without any, synthetic WhatsApp exports are used. --estimate counts
+the tokens with the fast estimator instead of the tokenizer. The low-information filter
+is first checked on a lone "ok" between two messages of a user.
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+from dataset import percentile
+from backend import conversation_encoder
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm"))
+import deepseek_v2_tokenizer as dtok
+
+NAMES = ("Alice Martin", "Bob Dupont", "Chloé Bernard")
+MESSAGES = ("salut", "ok", "tu viens ce soir ?", "j'arrive vers 22h", "😂😂", "<Media omitted>", "lol",
+            "on se retrouve devant le cinéma <This message was edited>", "This message was deleted",
+            "trop bien, merci pour hier soir", "d'accord")
+
+def synthetic_export(count, messages=300):
+    rng = random.Random(0)
+    exports = []
+    for _ in range(count):
+        minutes = 0
+        lines = []
+        for _ in range(messages):
+            minutes += rng.choice((0, 1, 2, 5, 90))
+            hour, minute = 1 + (minutes // 60) % 12, minutes % 60
+            lines.append(f"12/31/23, {hour}:{minute:02d} PM - {rng.choice(NAMES)}: {rng.choice(MESSAGES)}")
+        exports.append("\n".join(lines))
+    return exports
+
+def check_low_information():
+    """A lone "ok" between two real messages of a user is dropped, as a message or a continuation line."""
+    for conversation in ("Alice: salut\nAlice: ok\nAlice: tu viens ce soir ?", "Alice: salut\nok\ntu viens ce soir ?"):
+        encoding = conversation_encoder.encode(conversation, ["Alice", "Bob"], drop_low_information=True)
+        assert encoding.conversation == "Al: salut / tu viens ce soir ?", f"low-information message kept: {encoding.conversation!r}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", help="glob of conversation files")
+    parser.add_argument("--tokenizer", default="deepseek-ai/DeepSeek-V3")
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--estimate", action="store_true")
+    args = parser.parse_args()
+
+    texts = [open(path, encoding="utf-8").read() for path in sorted(glob.glob(args.texts))] if args.texts else []
+    texts = texts or synthetic_export(args.count)
+    check_low_information()
+
+    def count(texts):
+        if args.estimate:
+            return [dtok.estimateTokens(text) for text in texts]
+        return dtok.tokenCounts(texts, args.tokenizer)
+
+    print(f"{'mode':>16} {'input':>9} {'encoded':>9} {'saved':>7} {'merged':>7} {'dropped':>8} {'p50 ms':>7}")
+    for drop in (False, True):
+        encodings, timings = [], []
+        for text in texts:
+            start = time.perf_counter()
+            encodings.append(conversation_encoder.encode(text, ["unidentifiable"], drop))
+            timings.append(time.perf_counter() - start)
+        before = sum(count(texts))
+        after = sum(count([encoding.conversation for encoding in encodings]))
+        print(f"{'drop low-info' if drop else 'encode':>16} {before:>9} {after:>9} {1 - after / before:>7.1%} "
+              f"{sum(e.merged for e in encodings):>7} {sum(e.dropped for e in encodings):>8} {percentile(timings, 50) * 1000:>7.2f}")
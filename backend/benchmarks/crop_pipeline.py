@@ -0,0 +1,85 @@
+"""
+Measures peak memory and per-image time of the decode -> crop -> OCR input path on
+multi-screenshot uploads, before (PIL RGB copy, crop, np.array per box) and after
+(crops are views into the decoded OpenCV array). Each mode runs in its own
+subprocess so that the reported peak RSS is not shared between them.
+By default the reader only does the greyscale conversion easyocr does on its
+input, to isolate the cost of the pipeline; --easyocr runs the real reader.
+
+    python backend/benchmarks/crop_pipeline.py [--images 10] [--boxes 30] [--easyocr]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+from PIL import Image
+from dataset import percentile
+from backend.vision import ocr
+
+class GreyscaleReader:
+    """Stand-in for easyocr.Reader that only converts its input like reformat_input does."""
+    def readtext(self, image):
+        cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_BGR2GRAY)
+        return []
+
+def synthetic_upload(images, boxes, width=1170, height=2532):
+    """PNG-encoded screenshots with `boxes` bubbles each, and the bubbles' xywhn."""
+    rng = np.random.default_rng(0)
+    files = []
+    for _ in range(images):
+        image = np.full((height, width, 3), 245, np.uint8)
+        image[::7] = rng.integers(0, 255, (len(image[::7]), width, 3), dtype=np.uint8)
+        files.append(cv2.imencode(".png", image)[1].tobytes())
+    rows = (np.arange(boxes) + 0.5) / boxes
+    xywhn = [[0.3 if i % 2 else 0.7, float(y), 0.5, 0.8 / boxes] for i, y in enumerate(rows)]
+    return files, xywhn
+
+def before(cv_image, xywhn, reader):
+    pil_image = Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
+    width, height = pil_image.size
+    for x, y, w, h in xywhn:
+        x1, x2, y1, y2 = int((x - w/2) * width), int((x + w/2) * width), int((y - h/2) * height), int((y + h/2) * height)
+        reader.readtext(np.array(pil_image.crop((x1, y1, x2, y2))))
+
+def after(cv_image, xywhn, reader):
+    boxes = [{'xywhn': b, 'cls': 0} for b in xywhn]
+    ocr.extract_text_from_boxes(cv_image, boxes, reader)
+
+def run_mode(mode, images, boxes, use_easyocr):
+    files, xywhn = synthetic_upload(images, boxes)
+    if use_easyocr:
+        from easyocr import Reader
+        reader = Reader(['fr'], gpu=False)
+    else:
+        reader = GreyscaleReader()
+    decoded = [cv2.imdecode(np.frombuffer(f, np.uint8), cv2.IMREAD_COLOR) for f in files]  # an upload is decoded upfront
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for cv_image in decoded:
+        start = time.perf_counter()
+        (before if mode == "before" else after)(cv_image, xywhn, reader)
+        timings.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "peak_rss_mb": peak / 1024, "growth_mb": (peak - baseline) / 1024,
+                      "mean_ms": sum(timings) / len(timings) * 1000, "p95_ms": percentile(timings, 95) * 1000}))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--boxes", type=int, default=30)
+    parser.add_argument("--easyocr", action="store_true")
+    parser.add_argument("--mode", choices=("before", "after"))
+    args = parser.parse_args()
+    if args.mode:
+        run_mode(args.mode, args.images, args.boxes, args.easyocr)
+    else:
+        for mode in ("before", "after"):
+            command = [sys.executable, __file__, "--mode", mode, "--images", str(args.images), "--boxes", str(args.boxes)]
+            output = subprocess.run(command + (["--easyocr"] if args.easyocr else []), capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>6}: peak RSS {result['peak_rss_mb']:.0f} MB (+{result['growth_mb']:.0f} MB during OCR), "
+                  f"{result['mean_ms']:.1f} ms/image mean, {result['p95_ms']:.1f} ms/image p95")
@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+DATASET_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vision", "dataset")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".webp")
+
+def labeled_images(splits=("val",), limit=None):
+    """
+    Yields (image_path, boxes) for the images of the YOLO dataset that have a label file.
+    Boxes use the format of classifier.getBoxesFromImages, with a confidence of 1.
+    """
+    count = 0
+    for split in splits:
+        image_dir = os.path.join(DATASET_DIR, split, "images")
+        label_dir = os.path.join(DATASET_DIR, split, "labels")
+        if not os.path.isdir(image_dir):
+            print(f"Missing {image_dir}: images are not versioned, copy them from dataset/raw with labeling.organize_dataset")
+            continue
+        for file in sorted(os.listdir(image_dir)):
+            stem, extension = os.path.splitext(file)
+            label_path = os.path.join(label_dir, stem + ".txt")
+            if extension.lower() not in IMAGE_EXTENSIONS or not os.path.exists(label_path):
+                continue
+            boxes = []
+            with open(label_path, "r") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 5:
+                        continue
+                    xywhn = [float(v) for v in parts[1:]]
+                    boxes.append({'xywhn': xywhn, 'conf': 1.0, 'cls': int(parts[0]), 'posClass': 1 if xywhn[0] > 0.5 else 0})
+            yield os.path.join(image_dir, file), boxes
+            count += 1
+            if limit and count >= limit:
+                return
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
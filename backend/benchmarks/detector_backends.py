@@ -0,0 +1,88 @@
+"""
+Compares the detector backends on the labeled dataset: latency (one image per
+call), throughput (batches of --batch images) and box agreement. Agreement is
+the F1 score of boxes matched one-to-one by class and IoU >= 0.5, against the
+PyTorch backend and against the ground-truth labels.
+Backends that were not exported (python backend/vision/detector.py --backend ...) are skipped.
+
+    python backend/benchmarks/detector_backends.py [--split val] [--limit 100] [--imgsz 640] [--batch 8]
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+from dataset import labeled_images, percentile
+from backend.vision import classifier, detector
+
+def iou(a, b):
+    ax1, ay1, ax2, ay2 = classifier.xywhn_to_xyxy(a)
+    bx1, by1, bx2, by2 = classifier.xywhn_to_xyxy(b)
+    inter = max(0, min(ax2, bx2) - max(ax1, bx1)) * max(0, min(ay2, by2) - max(ay1, by1))
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - inter
+    return inter / union if union > 0 else 0
+
+def agreement(predicted, reference, threshold=0.5):
+    """Returns (matches, predicted count, reference count), greedily matching boxes of the same class by IoU."""
+    used = set()
+    matches = 0
+    for box in predicted:
+        best, best_iou = None, threshold
+        for j, other in enumerate(reference):
+            if j not in used and other['cls'] == box['cls']:
+                overlap = iou(box['xywhn'], other['xywhn'])
+                if overlap >= best_iou:
+                    best, best_iou = j, overlap
+        if best is not None:
+            used.add(best)
+            matches += 1
+    return matches, len(predicted), len(reference)
+
+def f1(counts):
+    matches = sum(c[0] for c in counts)
+    predicted = sum(c[1] for c in counts)
+    reference = sum(c[2] for c in counts)
+    return 2 * matches / (predicted + reference) if predicted + reference else 1.0
+
+def run(split, limit, imgsz, batch, weights):
+    dataset = list(labeled_images((split,), limit))
+    images = [cv2.imread(path) for path, _ in dataset]
+    labels = [boxes for _, boxes in dataset]
+    if not images:
+        return
+    candidates = [("torch", False), ("onnx", False), ("onnx", True), ("openvino", False), ("openvino", True)]
+    reference = None
+    print(f"{len(images)} images, imgsz {imgsz}")
+    print(f"{'backend':>14} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>7} {'F1 vs torch':>12} {'F1 vs labels':>13}")
+    for backend, int8 in candidates:
+        try:
+            model = detector.Detector(weights, backend, imgsz, int8)
+        except (FileNotFoundError, ImportError) as e:
+            print(f"{backend + ('-int8' if int8 else ''):>14} skipped: {e}")
+            continue
+        model([images[0]])  # warm-up
+        latencies, results = [], []
+        for image in images:
+            start = time.perf_counter()
+            results += classifier.getBoxesFromImages([image], model)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(0, len(images), batch):
+            classifier.getBoxesFromImages(images[i:i + batch], model)
+        throughput = len(images) / (time.perf_counter() - start)
+        boxes = [r['boxes'] for r in results]
+        if reference is None:
+            reference = boxes
+        vs_torch = f1([agreement(b, r) for b, r in zip(boxes, reference)])
+        vs_labels = f1([agreement(b, l) for b, l in zip(boxes, labels)])
+        print(f"{model.name:>14} {percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 95) * 1000:>8.1f} "
+              f"{throughput:>7.1f} {vs_torch:>12.3f} {vs_labels:>13.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", default="val")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--weights", default="backend/vision/best.pt")
+    args = parser.parse_args()
+    run(args.split, args.limit, args.imgsz, args.batch, args.weights)
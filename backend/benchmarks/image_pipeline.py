@@ -0,0 +1,78 @@
+"""
+Wall-clock time and peak memory of utilities.getImageMetadata on multi-image uploads
+of the labeled dataset: the previous phased flow (decode everything, detect
+everything, then OCR image by image) against the decode -> detect -> OCR pipeline.
+Each mode runs in its own subprocess so that the reported peak RSS is not shared,
+and both are checked to return the same results.
+
+    python backend/benchmarks/image_pipeline.py [--split val] [--images 10] [--ocr-engine per_box]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from dataset import labeled_images
+from easyocr import Reader
+from api import utilities
+from backend.vision import classifier, detector, ocr, stitching
+
+def phased(paths, vision_model, reader, ocr_engine):
+    """getImageMetadata before it was pipelined, with the same duplicate handling."""
+    converted_files = utilities.convert_input_images(paths)
+    img_results = classifier.getBoxesFromImages(converted_files, vision_model)
+    stitching.mark_duplicates(converted_files, img_results)
+    for cv_image, img_result in zip(converted_files, img_results):
+        unread = [box for box in img_result['boxes'] if not box.get('duplicate')]
+        if unread:
+            ocr.extract_text_from_boxes(cv_image, unread, reader, ocr_engine)
+        for box in img_result['boxes']:
+            box.setdefault('text', "")
+    contactName = utilities.findContactName(img_results)
+    metadata, conversation = utilities.compileAnalysis(utilities.addNames(img_results, contactName))
+    return metadata, conversation, img_results
+
+def run_mode(mode, split, images, ocr_engine, weights):
+    paths = [path for path, _ in labeled_images((split,), images)]
+    vision_model = detector.from_env(weights)
+    reader = Reader(['fr'], gpu=False)
+    vision_model([utilities.decode_input_image(paths[0])])  # warm-up
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            if mode == "phased":
+                result = phased(paths, vision_model, reader, ocr_engine)
+            else:
+                result = utilities.getImageMetadata(paths, vision_model, reader, ocr_engine=ocr_engine)
+        finally:
+            sys.stdout = stdout
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "images": len(paths), "seconds": elapsed, "peak_rss_mb": peak / 1024,
+                      "growth_mb": (peak - baseline) / 1024, "result": result[1]}))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", default="val")
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--ocr-engine", choices=ocr.OCR_ENGINES, default="per_box")
+    parser.add_argument("--weights", default="backend/vision/best.pt")
+    parser.add_argument("--mode", choices=("phased", "pipelined"))
+    args = parser.parse_args()
+    if args.mode:
+        run_mode(args.mode, args.split, args.images, args.ocr_engine, args.weights)
+    else:
+        conversations = set()
+        for mode in ("phased", "pipelined"):
+            command = [sys.executable, __file__, "--mode", mode, "--split", args.split, "--images", str(args.images),
+                       "--ocr-engine", args.ocr_engine, "--weights", args.weights]
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            conversations.add(result["result"])
+            print(f"{mode:>9}: {result['images']} images in {result['seconds']:.2f} s, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB (+{result['growth_mb']:.0f} MB during the request)")
+        print("same conversation" if len(conversations) == 1 else "conversations differ")
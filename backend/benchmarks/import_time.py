@@ -0,0 +1,59 @@
+"""
+Cold-start import time of the API process: runs `python -X importtime -c "import api.api"`
+in a fresh interpreter and reports the total, and the slowest top-level packages.
+Fails (exit status 1) when the import takes longer than --budget-ms, or when it loads
+a module that must only be loaded on first use (models, LLM client, GUI).
+
+    python backend/benchmarks/import_time.py [--module api.api] [--budget-ms 1500] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# loaded on first use: importing any of them at startup is a regression
+LAZY_MODULES = ("torch", "ultralytics", "easyocr", "transformers", "openai", "tkinter", "onnxruntime", "openvino")
+
+def import_times(module):
+    """(package, self us, cumulative us) for every import of `module`, in a fresh interpreter."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                            capture_output=True, text=True, check=True).stderr
+    times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append((name.rstrip()[1:], int(self_us), int(cumulative_us)))  # nested imports are indented
+    return times
+
+def report(module, budget_ms, top):
+    times = import_times(module)
+    # top-level imports are the ones that aren't indented: their cumulative times add up to the total
+    top_level = [(name.strip(), cumulative) for name, _, cumulative in times if name == name.strip()]
+    total_ms = sum(cumulative for _, cumulative in top_level) / 1000
+    packages = {}
+    for name, _, cumulative in times:
+        package = name.strip().split(".")[0]
+        if name.strip() == package:
+            packages[package] = max(packages.get(package, 0), cumulative)
+    print(f"import {module}: {total_ms:.0f} ms ({len(times)} modules), budget {budget_ms} ms")
+    for package, cumulative in sorted(packages.items(), key=lambda p: -p[1])[:top]:
+        print(f"{cumulative / 1000:>10.1f} ms  {package}")
+    loaded = sorted({name.strip().split(".")[0] for name, _, _ in times} & set(LAZY_MODULES))
+    failures = []
+    if total_ms > budget_ms:
+        failures.append(f"over budget by {total_ms - budget_ms:.0f} ms")
+    if loaded:
+        failures.append(f"loaded at import instead of on first use: {', '.join(loaded)}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return not failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="api.api")
+    parser.add_argument("--budget-ms", type=float, default=1500)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    sys.exit(0 if report(args.module, args.budget_ms, args.top) else 1)
@@ -0,0 +1,66 @@
+"""
+The DeepSeek client against the local stub server: fires --calls completions from
+--threads request threads (create()) and then as one batch (map()), with injected
+latency and errors, and reports the latency percentiles, the retries and failures, the
+calls the stub saw in flight (at most CHATBRAIN_LLM_MAX_INFLIGHT) and the connections
+they used (reused by the keep-alive pool).
+
+    python backend/benchmarks/llm_client.py [--calls 64] [--threads 16] [--latency-ms 200] [--error-rate 0.1] [--max-inflight 8]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataset import percentile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm"))
+import deepseek_client
+import stub_server
+
+def request(i):
+    return {"model": "deepseek-chat", "max_tokens": 200, "response_format": {"type": "json_object"},
+            "messages": [{"role": "system", "content": "Benchmark"}, {"role": "user", "content": f"Call {i}"}]}
+
+def timed_create(client, i):
+    start = time.perf_counter()
+    try:
+        client.create(**request(i))
+        return time.perf_counter() - start, None
+    except Exception as e:
+        return time.perf_counter() - start, e
+
+def report(name, wall, timings, errors, client, stub):
+    stats, counts = client.stats(), stub.stats()
+    print(f"{name:>8} {wall:>8.2f} {percentile(timings, 50) * 1000:>8.0f} {percentile(timings, 95) * 1000:>8.0f} "
+          f"{stats['retries']:>8} {len(errors):>7} {counts['max_inflight']:>9} {counts['connections']:>12}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    parser.add_argument("--max-inflight", type=int, default=8)
+    parser.add_argument("--deadline", type=float, default=30)
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'wall s':>8} {'p50 ms':>8} {'p95 ms':>8} {'retries':>8} {'failed':>7} {'inflight':>9} {'connections':>12}")
+    for mode in ("create", "map"):
+        stub = stub_server.StubServer(latency=args.latency_ms / 1000, jitter=args.latency_ms / 4000, error_rate=args.error_rate)
+        client = deepseek_client.DeepSeekClient("stub", stub.start(), max_inflight=args.max_inflight,
+                                                max_connections=args.max_inflight, deadline=args.deadline, backoff=0.05)
+        start = time.perf_counter()
+        if mode == "create":
+            with ThreadPoolExecutor(args.threads) as executor:
+                results = list(executor.map(lambda i: timed_create(client, i), range(args.calls)))
+            timings = [seconds for seconds, _ in results]
+            errors = [error for _, error in results if error is not None]
+        else:
+            responses = client.map([request(i) for i in range(args.calls)])
+            # map() returns once every call is done: each call's latency isn't observed on its own
+            timings = [time.perf_counter() - start]
+            errors = [response for response in responses if isinstance(response, Exception)]
+        report(mode, time.perf_counter() - start, timings, errors, client, stub)
+        client.close()
+        stub.stop()
@@ -0,0 +1,50 @@
+"""
+Compares the OCR engines of backend/vision/ocr.py on the labeled dataset, using
+the ground-truth boxes so that only OCR is measured.
+The dataset has no transcriptions, so character accuracy is reported against the
+"per_box" engine (the current behavior): 1 - edit distance / reference length.
+
+    python backend/benchmarks/ocr_engines.py [--split val] [--limit 50] [--batch-size 16]
+"""
+import argparse
+import copy
+import time
+from dataset import labeled_images, levenshtein, percentile
+from PIL import Image
+from easyocr import Reader
+from backend.vision import ocr
+
+def run(split, limit, batch_size):
+    reader = Reader(['fr'], gpu=False)
+    timings = {engine: [] for engine in ocr.OCR_ENGINES}
+    errors, reference_chars, images, boxes_count = 0, 0, 0, 0
+
+    for image_path, boxes in labeled_images((split,), limit):
+        image = Image.open(image_path).convert("RGB")
+        texts = {}
+        for engine in ocr.OCR_ENGINES:
+            engine_boxes = copy.deepcopy(boxes)
+            start = time.perf_counter()
+            ocr.extract_text_from_boxes(image, engine_boxes, reader, engine, batch_size)
+            timings[engine].append(time.perf_counter() - start)
+            texts[engine] = [box['text'] for box in engine_boxes]
+        for reference, candidate in zip(texts["per_box"], texts["batched"]):
+            errors += levenshtein(reference, candidate)
+            reference_chars += len(reference)
+        images += 1
+        boxes_count += len(boxes)
+
+    print(f"{images} images, {boxes_count} boxes")
+    for engine, values in timings.items():
+        if values:
+            print(f"{engine:>8}: total {sum(values):.2f}s, mean {sum(values) / len(values) * 1000:.0f} ms/image, p95 {percentile(values, 95) * 1000:.0f} ms/image")
+    if reference_chars:
+        print(f"batched character accuracy vs per_box: {1 - errors / reference_chars:.2%} ({errors} edits over {reference_chars} chars)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", default="val")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+    run(args.split, args.limit, args.batch_size)
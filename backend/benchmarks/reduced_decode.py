@@ -0,0 +1,70 @@
+"""
+Decode time and memory of a 12-megapixel phone screenshot (3024x4032), as JPEG and
+PNG, in three modes:
+- full: the full-resolution decode
+- reduced: the reduced decode of utilities.decode_reduced that feeds the detector, alone,
+  as for a screenshot whose bubbles are all duplicates
+- reduced+ocr: the reduced decode, then the full-resolution decode for OCR, end to end,
+  as for every screenshot with bubbles to read
+Each format and mode runs in its own subprocess so that the reported peak RSS growth is its own.
+
+    python backend/benchmarks/reduced_decode.py [--repeat 10] [--imgsz 640]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+from dataset import percentile
+from api import utilities
+
+def screenshot(width=3024, height=4032):
+    """A chat-like screenshot: flat background, bubbles and text-like noise."""
+    rng = np.random.default_rng(0)
+    image = np.full((height, width, 3), 245, np.uint8)
+    for top in range(100, height - 300, 350):
+        left = 150 if rng.random() > 0.5 else width // 3
+        image[top:top + 250, left:left + width // 2] = (200, 160, 60)
+        for row in range(top + 40, top + 220, 60):
+            image[row:row + 30, left + 40:left + width // 2 - 40] = rng.integers(0, 255, (30, width // 2 - 80, 3), dtype=np.uint8)
+    return image
+
+def run_mode(fmt, mode, repeat, imgsz):
+    content = cv2.imencode("." + fmt, screenshot())[1].tobytes()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if mode in ("reduced", "reduced+ocr"):
+            frame, factor = utilities.decode_reduced(content, imgsz)
+            if mode == "reduced+ocr" and factor > 1:
+                frame = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            frame, factor = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR), 1
+        timings.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"shape": frame.shape[:2], "factor": factor, "frame_mb": frame.nbytes / 2**20,
+                      "growth_mb": (peak - baseline) / 1024, "p50_ms": percentile(timings, 50) * 1000,
+                      "p95_ms": percentile(timings, 95) * 1000, "encoded_mb": len(content) / 2**20}))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--format", choices=("jpg", "png"))
+    parser.add_argument("--mode", choices=("full", "reduced", "reduced+ocr"))
+    args = parser.parse_args()
+    if args.mode:
+        run_mode(args.format, args.mode, args.repeat, args.imgsz)
+    else:
+        print(f"{'format':>6} {'mode':>11} {'frame':>10} {'frame MB':>9} {'peak +MB':>9} {'p50 ms':>8} {'p95 ms':>8}")
+        for fmt in ("jpg", "png"):
+            for mode in ("full", "reduced", "reduced+ocr"):
+                command = [sys.executable, __file__, "--format", fmt, "--mode", mode, "--repeat", str(args.repeat), "--imgsz", str(args.imgsz)]
+                output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+                r = json.loads(output.strip().splitlines()[-1])
+                print(f"{fmt:>6} {mode:>11} {r['shape'][1]:>4}x{r['shape'][0]:<5} {r['frame_mb']:>9.1f} {r['growth_mb']:>9.1f} "
+                      f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f}")
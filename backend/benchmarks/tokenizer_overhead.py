@@ -0,0 +1,94 @@
+"""
+Per-request overhead of the LLM price check (withinPriceLimit): the tokenizer loaded twice
+per request as apiCallPrice used to, the tokenizer cached by the process, and the fast
+estimate. Also compares counting many texts one at a time and in one batch, and reports
+the error of the estimate against the tokenizer.
+
+    python backend/benchmarks/tokenizer_overhead.py [--texts 'chats/*.txt'] [--requests 20] [--calibrate]
+
+Each --texts file is one request's conversation; without any, synthetic chats are used.
+--calibrate fits the estimator to the tokenizer on the texts (one fit per line and per
+file) and saves it to backend/llm/token_estimator.json, which the price checks then use.
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+from dataset import percentile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm"))
+import deepseek_v2_tokenizer as dtok
+
+WORDS = ("salut", "ça", "va", "oui", "non", "demain", "ce soir", "j'arrive", "désolé", "trop bien", "haha", "ok",
+         "on se voit", "à quelle heure", "t'es où", "merci", "see", "you", "later", "!", "?", "...", "😂", "❤️")
+
+def synthetic_chats(count, messages=200):
+    rng = random.Random(0)
+    chats = []
+    for _ in range(count):
+        lines = [f"{rng.choice(('A', 'B'))}: " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 15)))
+                 for _ in range(messages)]
+        chats.append("\n".join(lines))
+    return chats
+
+def legacy_price(text, output_size, tokenizer_dir):
+    """apiCallPrice before the cache: tokenCount loaded the tokenizer, and was called twice."""
+    import transformers
+    for _ in range(2):
+        tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_dir, trust_remote_code=True)
+        count = len(tokenizer.encode(text))
+    return (count + output_size) * 0.14 / 1e6, count
+
+def time_per_request(price, texts):
+    timings = []
+    for text in texts:
+        start = time.perf_counter()
+        price(text)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(name, timings):
+    print(f"{name:>22} {percentile(timings, 50) * 1000:>9.2f} {percentile(timings, 95) * 1000:>9.2f} {sum(timings) * 1000:>10.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", help="glob of conversation files, one per request")
+    parser.add_argument("--tokenizer", default="deepseek-ai/DeepSeek-V3")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--output-size", type=int, default=2000)
+    parser.add_argument("--calibrate", action="store_true")
+    args = parser.parse_args()
+
+    texts = [open(path, encoding="utf-8").read() for path in sorted(glob.glob(args.texts))] if args.texts else []
+    texts = (texts or synthetic_chats(args.requests))[:args.requests]
+    if args.calibrate:
+        samples = texts + [line for text in texts for line in text.splitlines() if line.strip()]
+        estimator = dtok.calibrateEstimator(samples, args.tokenizer)
+        print(f"Calibrated on {estimator['texts']} texts: mean error {estimator['mean_relative_error']:.1%}, "
+              f"p99 error {estimator['max_relative_error']:.1%}, saved to {dtok.ESTIMATOR_PATH}")
+
+    print(f"{len(texts)} requests, {sum(map(len, texts)) / len(texts):.0f} characters on average")
+    print(f"{'mode':>22} {'p50 ms':>9} {'p95 ms':>9} {'total ms':>10}")
+    start = time.perf_counter()
+    dtok.loadTokenizer(args.tokenizer)
+    print(f"{'first load (once)':>22} {'':>9} {'':>9} {(time.perf_counter() - start) * 1000:>10.1f}")
+    report("legacy (2 loads)", time_per_request(lambda text: legacy_price(text, args.output_size, args.tokenizer), texts))
+    report("cached tokenizer", time_per_request(lambda text: dtok.apiCallPrice(text, args.output_size, args.tokenizer), texts))
+    report("estimate", time_per_request(lambda text: dtok.apiCallPrice(text, args.output_size, args.tokenizer, estimate=True), texts))
+
+    lines = [line for text in texts for line in text.splitlines()]
+    start = time.perf_counter()
+    exact = [dtok.tokenCount(line, args.tokenizer) for line in lines]
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = dtok.tokenCounts(lines, args.tokenizer)
+    batch = time.perf_counter() - start
+    assert batched == exact
+    print(f"Counting {len(lines)} lines: {loop * 1000:.1f} ms one by one, {batch * 1000:.1f} ms in one batch")
+
+    errors = [abs(dtok.estimateTokens(text) - count) / max(count, 1)
+              for text, count in zip(texts, dtok.tokenCounts(texts, args.tokenizer))]
+    print(f"Estimate error per request: p50 {percentile(errors, 50):.1%}, max {max(errors):.1%} "
+          f"(calibration bound {dtok.loadEstimator().get('max_relative_error', 0):.1%})")
@@ -0,0 +1,119 @@
+"""
+Starts the production server (api/gunicorn.conf.py) with more and more workers and
+reports, for each count, the unique memory of each worker (USS: its private pages,
+so the weights shared copy-on-write with the master are not counted), the total PSS
+of the server, and the /metadata throughput of --clients concurrent clients posting
+images of the labeled dataset for --seconds. Linux only (reads /proc/<pid>/smaps_rollup).
+
+    python backend/benchmarks/worker_memory.py [--workers 1 2 4 8] [--clients 8] [--seconds 20]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from dataset import labeled_images
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def smaps_rollup(pid):
+    """Memory counters of a process in kB, from /proc/<pid>/smaps_rollup."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                values[parts[0].rstrip(":")] = int(parts[1])
+    return values
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+def multipart(paths):
+    """Body and content type of a /metadata upload of the images at `paths`."""
+    boundary = uuid.uuid4().hex
+    body = b""
+    for path in paths:
+        extension = os.path.splitext(path)[1].lstrip(".").lower().replace("jpg", "jpeg")
+        with open(path, "rb") as f:
+            body += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{os.path.basename(path)}\"\r\n"
+                     f"Content-Type: image/{extension}\r\n\r\n").encode() + f.read() + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+def wait_ready(url, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + "/metadata/admission", timeout=5)
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(1)
+    raise TimeoutError(f"server not ready after {timeout}s")
+
+def load(url, uploads, clients, seconds):
+    """Requests per second served to `clients` clients posting `uploads` in turn, and the number of errors."""
+    done, errors = [0], [0]
+    deadline = time.time() + seconds
+
+    def client(offset):
+        i = offset
+        while time.time() < deadline:
+            body, content_type = uploads[i % len(uploads)]
+            request = urllib.request.Request(url + "/metadata", data=body, headers={"Content-Type": content_type})
+            try:
+                urllib.request.urlopen(request, timeout=120).read()
+                done[0] += 1
+            except (urllib.error.URLError, ConnectionError):
+                errors[0] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return done[0] / (time.time() - start), errors[0]
+
+def run(worker_counts, clients, seconds, port, split, images):
+    paths = [path for path, _ in labeled_images((split,), images)]
+    if not paths:
+        return
+    uploads = [multipart([path]) for path in paths]
+    url = f"http://127.0.0.1:{port}"
+    print(f"{'workers':>7} {'master USS MB':>14} {'worker USS MB':>14} {'total PSS MB':>13} {'req/s':>7} {'errors':>7}")
+    for count in worker_counts:
+        env = dict(os.environ, CHATBRAIN_WORKERS=str(count), CHATBRAIN_BIND=f"127.0.0.1:{port}",
+                   CHATBRAIN_INFERENCE_SLOTS=os.getenv("CHATBRAIN_INFERENCE_SLOTS", "64"))
+        server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "api/gunicorn.conf.py"], cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(url)
+            throughput, errors = load(url, uploads, clients, seconds)
+            # measured after the load, once the workers touched everything they use
+            workers = children(server.pid)
+            master = smaps_rollup(server.pid)
+            rollups = [smaps_rollup(pid) for pid in workers]
+            uss = [(r.get("Private_Clean", 0) + r.get("Private_Dirty", 0)) / 1024 for r in rollups]
+            pss = (master.get("Pss", 0) + sum(r.get("Pss", 0) for r in rollups)) / 1024
+            master_uss = (master.get("Private_Clean", 0) + master.get("Private_Dirty", 0)) / 1024
+            print(f"{count:>7} {master_uss:>14.0f} {sum(uss) / len(uss):>14.0f} {pss:>13.0f} {throughput:>7.2f} {errors:>7}")
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--split", default="val")
+    parser.add_argument("--images", type=int, default=20)
+    args = parser.parse_args()
+    run(args.workers, args.clients, args.seconds, args.port, args.split, args.images)
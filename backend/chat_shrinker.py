@@ -1,6 +1,4 @@
 import re
-import tkinter as tk
-from tkinter import filedialog, simpledialog
 from datetime import datetime, timedelta
 
 def search_start(messages, start_datetime):
@@ -264,6 +262,10 @@ def shrink_whatsapp_chat(file, start_date=None, end_date=None, start_time=None,
     return result_str, msgCount, n_users, names, usernames
 
 if __name__ == "__main__":
+    # GUI-only, kept out of the API process
+    import tkinter as tk
+    from tkinter import filedialog, simpledialog
+
     def get_user_input(prompt):
         root = tk.Tk()
         root.withdraw()
@@ -0,0 +1,186 @@
+"""
+Encodes a conversation into fewer tokens before it is sent to the LLM, with the ideas of
+chat_shrinker: every user gets a short alias (chat_shrinker.create_nickname), timestamps
+are only kept as a marker when more than an hour passed, and platform noise (system lines,
+edit markers, omitted media) is dropped. Consecutive messages of a user are also merged,
+and low-information messages ("ok", "lol", lone emojis) can be dropped. The analysis of
+the encoded conversation is mapped back to the real names with Encoding.decode.
+"""
+import functools
+import json
+import re
+from datetime import datetime, timedelta
+from backend import chat_shrinker
+
+# "12/31/23, 9:15 PM - Alice: message" (Android) and "[31/12/23, 21:15:03] Alice: message" (iOS)
+ANDROID_LINE = re.compile(r'^(\d{1,2}/\d{1,2}/\d{2,4}),?\s*(\d{1,2}:\d{2}(?:\s?(?:AM|PM))?)\s*-\s*(.*)$')
+IOS_LINE = re.compile(r'^‎?\[(\d{1,2}/\d{1,2}/\d{2,4}),?\s*(\d{1,2}:\d{2}(?::\d{2})?(?:\s?(?:AM|PM))?)\]\s*(.*)$')
+SPEAKER = re.compile(r'^([^:\n]{1,40}?)\s*:\s?(.*)$')
+# Markers removed from messages
+MARKERS = re.compile(r'\s*(<This message was edited>|<Ce message a été modifié>|\(edited\)|\(modifié\)|‎)\s*')
+# Messages that are only platform noise. Lines with a timestamp but no speaker are system
+# events (encryption notice, group changes...) and are dropped by parse_messages
+NOISE = re.compile(
+    r'^(<Media omitted>|<Médias omis>|<attached: .*>|image omitted|video omitted|sticker omitted|audio omitted|GIF omitted|'
+    r'null|This message was deleted\.?|You deleted this message\.?|Ce message a été supprimé\.?|'
+    r'Vous avez supprimé ce message\.?|Missed (voice|video) call|Appel (vocal|vidéo) manqué)$', re.IGNORECASE)
+LOW_INFORMATION = {"ok", "okay", "oki", "k", "kk", "lol", "mdr", "ptdr", "haha", "hahaha", "ah", "oh", "yes", "yep",
+                   "oui", "ouais", "no", "non", "nan", "cool", "thx", "merci", "d'accord", "dac", "np", "+1"}
+# Aliases that would read as ordinary words where they are mapped back in the insights
+RESERVED_ALIASES = {"A", "I", "O", "Y", "À", "Je", "Tu", "Il", "On", "Le", "La", "Ma", "Me", "Ta", "Sa", "Un",
+                    "My", "No", "So", "We", "He", "It", "In", "At", "To", "Of", "Or", "If", "An", "Be", "Do", "Go"}
+TIME_GAP = timedelta(hours=1)
+MERGE_SEPARATOR = " / "
+DATE_FORMATS = ("%m/%d/%y", "%m/%d/%Y", "%d/%m/%y", "%d/%m/%Y")
+TIME_FORMATS = ("%I:%M %p", "%I:%M%p", "%H:%M", "%H:%M:%S", "%I:%M:%S %p")
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(date_str, time_str):
+    """The datetime of a message's timestamp, or None if no format matches."""
+    for date_format in DATE_FORMATS:
+        for time_format in TIME_FORMATS:
+            try:
+                return datetime.strptime(f"{date_str} {time_str}", f"{date_format} {time_format}")
+            except ValueError:
+                continue
+    return None
+
+def is_low_information(text):
+    """Messages without a letter or digit (emojis, punctuation), or a lone acknowledgement."""
+    stripped = text.strip().lower().strip(".!?~ ")
+    return not any(c.isalnum() for c in text) or stripped in LOW_INFORMATION
+
+def parse_messages(conversation, users):
+    """
+    Splits `conversation` into [{"user", "text", "time", "stamp"}]. With known `users`, only their
+    names start a message; otherwise any short "Name: " prefix does. Lines without a speaker
+    continue the previous message, except timestamped ones, which are system events.
+    """
+    known = {user for user in users if user != "unidentifiable"}
+    messages = []
+    for line in conversation.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        stamp = ANDROID_LINE.match(line) or IOS_LINE.match(line)
+        rest = stamp.group(3) if stamp else line
+        speaker = SPEAKER.match(rest)
+        if speaker and (speaker.group(1) in known or (not known and re.fullmatch(r"[\w .'-]+", speaker.group(1)))):
+            time = parse_timestamp(stamp.group(1), stamp.group(2)) if stamp else None
+            messages.append({"user": speaker.group(1), "text": speaker.group(2), "time": time,
+                             "stamp": f"{stamp.group(1)} {stamp.group(2)}" if stamp else None})
+        elif stamp:
+            continue
+        elif messages:
+            messages[-1]["text"] += "\n" + line
+        else:
+            messages.append({"user": None, "text": line, "time": None, "stamp": None})
+    return messages
+
+
+class Encoding:
+    """An encoded conversation, with the aliases of its users to map the analysis back."""
+
+    def __init__(self, conversation, aliases, messages, merged, dropped):
+        self.conversation = conversation
+        # alias -> real name
+        self.aliases = aliases
+        self.messages = messages
+        self.merged = merged
+        self.dropped = dropped
+        # token counts before and after encoding, when they were counted
+        self.input_tokens = None
+        self.output_tokens = None
+
+    @property
+    def users(self):
+        return list(self.aliases) or ["unidentifiable"]
+
+    def _pattern(self):
+        # an alias is only replaced as a whole word: letters, digits and apostrophes don't end it
+        # on the left ("l'A" stays), but an apostrophe may follow it ("Al's")
+        names = sorted(self.aliases, key=len, reverse=True)
+        return re.compile(r"(?<![\w'’])(" + "|".join(re.escape(name) for name in names) + r")(?!\w)")
+
+    def decode_text(self, text):
+        if not self.aliases or not isinstance(text, str):
+            return text
+        return self._pattern().sub(lambda match: self.aliases[match.group(1)], text)
+
+    def decode_value(self, value):
+        """Maps the aliases back to the real names in dict keys and strings, recursively."""
+        if isinstance(value, dict):
+            return {self.aliases.get(key, key): self.decode_value(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.decode_value(item) for item in value]
+        return self.decode_text(value)
+
+    def decode(self, analysis_json):
+        """The analysis JSON with the real names. Output that isn't JSON is returned as is."""
+        if analysis_json is None or not self.aliases:
+            return analysis_json
+        try:
+            return json.dumps(self.decode_value(json.loads(analysis_json)), ensure_ascii=False)
+        except json.JSONDecodeError:
+            return analysis_json
+
+
+def encode(conversation, users, drop_low_information=False):
+    """
+    Encodes `conversation`, whose speakers are `users` (["unidentifiable"] if unknown):
+    - each of `users`, and each other speaker, is renamed to a short alias, at least two characters long
+    - timestamps become a "-- date time --" line, only when more than an hour passed
+    - system lines, edit markers, deleted and omitted messages are dropped
+    - consecutive messages of a speaker are merged on one line, separated by " / "
+    - with `drop_low_information`, messages with no word content are dropped
+    Each line of a message is filtered on its own, before the lines and messages are merged.
+    """
+    used = set(RESERVED_ALIASES)
+    aliases = {}
+    alias_of = {}
+    lines = []
+    merged = dropped = 0
+    last_time = None
+    last_user = None
+    messages = parse_messages(conversation, users)
+    known = [user for user in users if user != "unidentifiable"]
+    names = set(known) | {message["user"] for message in messages if message["user"] is not None}
+
+    def alias(user):
+        if user not in alias_of:
+            # single characters are too ambiguous to map back, and another user's name would be mistaken for them
+            alias_of[user] = chat_shrinker.create_nickname(user, used | {user[:1]} | (names - {user}))
+            used.add(alias_of[user])
+            aliases[alias_of[user]] = user
+        return alias_of[user]
+
+    # every known user keeps an alias, and so a place in the analysis, even without a message left
+    for user in known:
+        alias(user)
+    for message in messages:
+        # each line is filtered on its own: the continuation lines of pasted chats are often separate messages
+        parts = [MARKERS.sub(" ", line).strip() for line in message["text"].split("\n")]
+        kept = [line for line in parts
+                if line and not NOISE.match(line) and not (drop_low_information and is_low_information(line))]
+        dropped += len(parts) - len(kept)
+        if not kept:
+            continue
+        text = MERGE_SEPARATOR.join(kept)
+        if message["time"] is not None and (last_time is None or message["time"] - last_time > TIME_GAP):
+            lines.append(f"-- {message['stamp']} --")
+            last_user = None
+        if message["time"] is not None:
+            last_time = message["time"]
+        user = message["user"]
+        if user is None:
+            lines.append(text)
+            last_user = None
+            continue
+        if user == last_user:
+            lines[-1] += MERGE_SEPARATOR + text
+            merged += 1
+        else:
+            lines.append(f"{alias(user)}: {text}")
+            last_user = user
+    return Encoding("\n".join(lines), aliases, len(messages), merged, dropped)
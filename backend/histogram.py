@@ -0,0 +1,36 @@
+import bisect
+import threading
+
+# Default buckets (in seconds) for request and stage timings
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Fixed-bucket histogram that can be updated from several threads."""
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Returns the cumulative bucket counts, Prometheus style, with the count, sum and mean."""
+        with self._lock:
+            cumulative = []
+            running = 0
+            for le, n in zip(self.buckets + ["+Inf"], self.counts):
+                running += n
+                cumulative.append([le, running])
+            return {
+                "buckets": cumulative,
+                "count": self.count,
+                "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else None
+            }
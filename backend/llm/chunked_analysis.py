@@ -0,0 +1,231 @@
+"""
+Analysis of conversations too long for one call under the price guard: the conversation
+is split at message boundaries into windows that each fit the guard, the windows are
+analyzed concurrently, their metrics are averaged, and a short final call writes the
+insights from those of the windows.
+"""
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from backend import metrics
+from backend.llm import llm_analysis
+import response_cache
+import deepseek_client
+
+# Windows analyzed at once, across all requests of the process
+CONCURRENCY = int(os.getenv("CHATBRAIN_LLM_CONCURRENCY", 4))
+# Conversations needing more windows are refused, bounding the cost of one analysis
+MAX_WINDOWS = int(os.getenv("CHATBRAIN_LLM_MAX_WINDOWS", 12))
+# Fraction of the guard's token budget filled by a window: messages are counted separately,
+# and the joined window can tokenize slightly differently
+WINDOW_FILL = 0.9
+SYNTHESIS_OUTPUT_TOKENS = 600
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def getExecutor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix="llm-window")
+        return _executor
+
+def splitMessages(conversation, users):
+    """
+    The messages of `conversation`, one "user: text" line each. Lines that don't start with
+    one of `users` continue the previous message; without known users every line is a message.
+    """
+    prefixes = tuple(f"{user}: " for user in users if user != "unidentifiable")
+    messages = []
+    for line in conversation.splitlines():
+        if not line.strip():
+            continue
+        if messages and prefixes and not line.startswith(prefixes):
+            messages[-1] += "\n" + line
+        else:
+            messages.append(line)
+    return messages
+
+def splitLongMessage(message, tokens, budget):
+    """
+    Splits a message longer than `budget` tokens into pieces of proportional length: at word
+    boundaries, and inside the words longer than a piece (text without spaces, like CJK or URLs).
+    """
+    size = math.ceil(len(message) / math.ceil(tokens / budget))
+    pieces, piece = [], ""
+    for word in message.split(" "):
+        while len(word) > size:
+            if piece:
+                pieces.append(piece)
+                piece = ""
+            pieces.append(word[:size])
+            word = word[size:]
+        if piece and len(piece) + 1 + len(word) > size:
+            pieces.append(piece)
+            piece = word
+        else:
+            piece = f"{piece} {word}" if piece else word
+    if piece:
+        pieces.append(piece)
+    return [(piece, math.ceil(tokens * len(piece) / max(len(message), 1))) for piece in pieces]
+
+def windowBudget(systemPrompt, maxOutputTokens):
+    """Prompt tokens a window may use so that its call stays under the price guard."""
+    guard_tokens = llm_analysis.PRICE_LIMIT * 1e6 / llm_analysis.dtok.PRICE_PER_M_TOKENS
+    budget = guard_tokens - maxOutputTokens - llm_analysis.countTokens([systemPrompt])[0]
+    if llm_analysis.TOKEN_COUNT_MODE != "exact":
+        # estimates are off by at most this fraction of the exact count, so that a window fits whatever its estimate
+        budget *= 1 - llm_analysis.dtok.loadEstimator().get("max_relative_error", 0.35)
+    return int(budget * WINDOW_FILL)
+
+def splitWindows(conversation, users, budget):
+    """
+    Packs the messages of `conversation` in order into windows of at most `budget` tokens.
+    Returns [(text, tokens, {user: tokens})], the last giving the size of each user's messages.
+    """
+    messages = splitMessages(conversation, users)
+    counted = []
+    for message, tokens in zip(messages, llm_analysis.countTokens(messages)):
+        counted.extend(splitLongMessage(message, tokens, budget) if tokens > budget else [(message, tokens)])
+
+    windows = []
+    lines, size, user_tokens = [], 0, {}
+    for message, tokens in counted:
+        if lines and size + tokens > budget:
+            windows.append(("\n".join(lines), size, user_tokens))
+            lines, size, user_tokens = [], 0, {}
+        lines.append(message)
+        size += tokens
+        user = message.split(": ", 1)[0]
+        user_tokens[user] = user_tokens.get(user, 0) + tokens
+    if lines:
+        windows.append(("\n".join(lines), size, user_tokens))
+    return windows
+
+def analyzeWindow(window, maxOutputTokens, users):
+    """The parsed analysis of one window, or None if it failed, was refused, too expensive or not valid JSON."""
+    text, _, _ = window
+    try:
+        content, _ = llm_analysis.promptToJSON(text, maxOutputTokens, users)
+    except deepseek_client.call_errors() as e:
+        # the other windows are paid for already: the analysis goes on without this one
+        metrics.log_event("window_discarded", reason="call_failed", error=str(e))
+        return None
+    if content is None:
+        return None
+    try:
+        analysis = json.loads(content)
+    except json.JSONDecodeError:
+        metrics.log_event("window_discarded", reason="invalid_json")
+        return None
+    return analysis if isinstance(analysis, dict) else None
+
+def weightedMeans(samples):
+    """Rounded weighted mean of every numeric key of [(dict, weight)]."""
+    totals, weights = {}, {}
+    for values, weight in samples:
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value * weight
+                weights[key] = weights.get(key, 0) + weight
+    return {key: round(totals[key] / weights[key]) for key in totals if weights[key] > 0}
+
+def windowInsights(analysis):
+    """The insights of a window analysis, at the top level or under "users" as the prompt's format puts them."""
+    insights = analysis.get("insights") or (analysis.get("users") or {}).get("insights") or []
+    return [insight for insight in insights if isinstance(insight, str)]
+
+def reduceAnalyses(windows, analyses):
+    """
+    Combines the window analyses into one: the conversation metrics are averaged weighted by
+    window size, and each user's scores weighted by the size of their messages in the window.
+    """
+    conversation_samples, user_samples = [], {}
+    for (_, tokens, user_tokens), analysis in zip(windows, analyses):
+        if analysis is None:
+            continue
+        if isinstance(analysis.get("conversation_metrics"), dict):
+            conversation_samples.append((analysis["conversation_metrics"], tokens))
+        for user, scores in (analysis.get("users") or {}).items():
+            if user != "insights" and isinstance(scores, dict):
+                # users the model named differently than the conversation weigh as the whole window
+                user_samples.setdefault(user, []).append((scores, user_tokens.get(user, tokens)))
+    return {
+        "conversation_metrics": weightedMeans(conversation_samples),
+        "users": {user: weightedMeans(samples) for user, samples in user_samples.items()}
+    }
+
+def getSynthesisPrompt():
+    return """
+    You are given the metrics and the "DNA Insights" of consecutive excerpts of one long conversation,
+    produced by a forensic conversation analyst. Write the 3 "DNA Insights" of the whole conversation:
+    - MUST be an advanced inference and deduction, drawing on the insights of several excerpts
+    - MUST be precise and targeted
+    - Present in the language of the excerpt insights
+    - MUST be around 4 to 5 sentences long
+
+    IMPOSED OUTPUT JSON FORMAT: {"insights": ["Insight 1", "Insight 2", "Insight 3"]}
+  """
+
+def synthesizeInsights(reduced, insights):
+    """One short call writing the insights of the whole conversation from those of the windows."""
+    prompt = json.dumps({"metrics": reduced, "excerpt_insights": insights}, ensure_ascii=False)
+    try:
+        response = llm_analysis.api_call("deepseek-chat", SYNTHESIS_OUTPUT_TOKENS, prompt, getSynthesisPrompt(),
+                                         call="synthesis")
+        message = response.choices[0].message
+        if message.refusal is None:
+            synthesized = json.loads(message.content).get("insights")
+            if synthesized:
+                return synthesized, response
+    except (json.JSONDecodeError, AttributeError) + deepseek_client.call_errors() as e:
+        metrics.log_event("synthesis_failed", error=str(e))
+    # fall back on the first insights of evenly spaced windows
+    step = max(1, len(insights) // 3)
+    return insights[::step][:3], None
+
+def promptToJSONChunked(prompt, maxOutputTokens, users=[]):
+    """
+    Chunked variant of promptToJSON, for conversations over the price guard: returns the JSON
+    of the combined analysis and the response of the synthesis call (None if it was not used),
+    or (None, None) if the conversation needs more than CHATBRAIN_LLM_MAX_WINDOWS windows or
+    no window could be analyzed. The combined analysis is cached, even when the synthesis failed.
+    """
+    start = time.perf_counter()
+    key = response_cache.cache_key(prompt, users, llm_analysis.SYSTEM_PROMPT_VERSION, maxOutputTokens, "deepseek-chat-chunked")
+    cached = llm_analysis.analysis_cache.get(key)
+    if cached is not None:
+        llm_analysis.recordCacheHit("chunked", start, prompt)
+        return cached[0], None
+
+    budget = windowBudget(llm_analysis.getSystemPrompt(users), maxOutputTokens)
+    with metrics.timed("llm_windowing"):
+        windows = splitWindows(prompt, users, budget)
+    if not windows or len(windows) > MAX_WINDOWS:
+        metrics.log_event("chunked_analysis_refused", windows=len(windows), max_windows=MAX_WINDOWS)
+        return None, None
+
+    # the windows keep the request's metrics context in the executor's threads
+    executor = getExecutor()
+    futures = [executor.submit(contextvars.copy_context().run, analyzeWindow, window, maxOutputTokens, users)
+               for window in windows]
+    analyses = [future.result() for future in futures]
+    metrics.log_event("chunked_analysis", windows=len(windows), budget=budget,
+                      failed=sum(analysis is None for analysis in analyses))
+    if all(analysis is None for analysis in analyses):
+        return None, None
+
+    reduced = reduceAnalyses(windows, analyses)
+    insights = [insight for analysis in analyses if analysis is not None for insight in windowInsights(analysis)]
+    reduced["insights"], response = synthesizeInsights(reduced, insights)
+    reduced["windows"] = len(windows)
+    jsonOutput = json.dumps(reduced, ensure_ascii=False)
+    # without the synthesis response, the equivalent completion is stored, so the windows aren't paid for again
+    cached = response or llm_analysis.equivalentCompletion(key, "deepseek-chat", jsonOutput)
+    llm_analysis.analysis_cache.put(key, jsonOutput, cached.model_dump_json())
+    return jsonOutput, response
@@ -0,0 +1,238 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from backend import metrics
+
+# Statuses worth retrying: rate limited, or a transient server error
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+_DONE = object()
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class StreamInterrupted(RuntimeError):
+    """A stream that failed after some of its chunks were yielded, which can't be retried."""
+    pass
+
+
+def call_errors():
+    """The exceptions of a call that failed after its retries, to catch (openai is imported lazily)."""
+    import openai
+    return (openai.APIError, DeadlineExceeded)
+
+
+def _limits(max_connections):
+    # the HTTP library of the openai package: httpx, or httpx2 in recent versions
+    try:
+        import httpx
+    except ImportError:
+        import httpx2 as httpx
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+
+
+class DeepSeekClient:
+    """
+    Chat-completions client running on an asyncio event loop in a background thread, shared
+    by the whole process: one AsyncOpenAI client, so one keep-alive connection pool of at most
+    `max_connections`, and a semaphore bounding the calls in flight to `max_inflight`.
+
+    Every call has a `deadline` in seconds, covering its wait for the semaphore and its
+    retries. Rate-limited (429), 5xx, timed out and failed connections are retried up to
+    `max_retries` times, after an exponential backoff from `backoff` seconds with full jitter,
+    or after the server's Retry-After if longer.
+
+    Flask threads call create() and stream(), which block on the loop. Batch jobs can run
+    many calls at once with map(), or await acreate() from their own event loop.
+    """
+
+    def __init__(self, api_key, base_url, max_inflight=8, max_connections=16, deadline=120,
+                 max_retries=4, backoff=0.5, max_backoff=20):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_inflight = max_inflight
+        self.max_connections = max_connections
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._loop = None
+        self._pid = None
+        self._client = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self.counts = {"calls": 0, "retries": 0, "failures": 0, "deadline_exceeded": 0, "inflight": 0, "max_inflight": 0}
+
+    def _start(self):
+        """The event loop of the client, started on first use (in each process, as it doesn't survive a fork)."""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._client = None
+                threading.Thread(target=self._loop.run_forever, daemon=True, name="deepseek-client").start()
+            return self._loop
+
+    def _openai(self):
+        """The AsyncOpenAI client, built on the loop, since its connections belong to it."""
+        if self._client is None:
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+            # retries are ours, so that they share the deadline and the semaphore
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                       http_client=DefaultAsyncHttpxClient(limits=_limits(self.max_connections)))
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+        return self._client
+
+    def _retry_delay(self, error, attempt):
+        """Seconds to wait before retrying after `error`, or None if it isn't worth retrying."""
+        import openai
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code not in RETRYABLE_STATUSES:
+                return None
+            retry_after = error.response.headers.get("retry-after")
+        elif not isinstance(error, openai.APIConnectionError):
+            return None
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        try:
+            return max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            return delay
+
+    async def _call(self, end, call):
+        """Runs `call()` (a coroutine function) holding the semaphore, retrying it until `end`."""
+        client = self._openai()
+        attempt = 0
+        self.counts["calls"] += 1
+        while True:
+            remaining = end - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                return await asyncio.wait_for(self._hold(call, client, remaining), remaining)
+            except asyncio.TimeoutError:
+                self.counts["deadline_exceeded"] += 1
+                raise DeadlineExceeded(f"DeepSeek call exceeded its deadline after {attempt} retries")
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self.counts["failures"] += 1
+                    raise
+                if time.monotonic() + delay >= end:
+                    self.counts["deadline_exceeded"] += 1
+                    raise DeadlineExceeded(f"DeepSeek call would exceed its deadline retrying after: {e}") from e
+                attempt += 1
+                self.counts["retries"] += 1
+                metrics.observe("llm_backoff", delay)
+                await asyncio.sleep(delay)
+
+    async def _hold(self, call, client, remaining):
+        async with self._semaphore:
+            self.counts["inflight"] += 1
+            self.counts["max_inflight"] = max(self.counts["max_inflight"], self.counts["inflight"])
+            try:
+                return await call(client, remaining)
+            finally:
+                self.counts["inflight"] -= 1
+
+    def _submit(self, call, deadline):
+        end = time.monotonic() + (deadline or self.deadline)
+        return asyncio.run_coroutine_threadsafe(self._call(end, call), self._start())
+
+    def create(self, deadline=None, **kwargs):
+        """Blocking chat.completions.create(**kwargs), with the client's deadline, retries and concurrency limit."""
+        async def call(client, remaining):
+            return await client.chat.completions.create(timeout=remaining, **kwargs)
+        return self._submit(call, deadline).result()
+
+    async def acreate(self, deadline=None, **kwargs):
+        """create() for coroutines, from any event loop: the call itself runs on the client's loop."""
+        async def call(client, remaining):
+            return await client.chat.completions.create(timeout=remaining, **kwargs)
+        return await asyncio.wrap_future(self._submit(call, deadline))
+
+    def map(self, requests, deadline=None):
+        """
+        Runs a create() call for each of `requests` (dicts of its keyword arguments) at once, within
+        the concurrency limit. Returns their responses in order, or the exception of failed calls.
+        """
+        futures = []
+        for request in requests:
+            async def call(client, remaining, request=request):
+                return await client.chat.completions.create(timeout=remaining, **request)
+            futures.append(self._submit(call, deadline))
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stream(self, deadline=None, **kwargs):
+        """
+        Blocking streamed chat.completions.create(**kwargs): yields the chunks as they arrive.
+        The call is retried until its first chunk, and the whole stream must end within the deadline.
+        A stream failing after its first chunk raises StreamInterrupted once its chunks are consumed.
+        """
+        chunks = queue.Queue()
+
+        async def call(client, remaining):
+            received = False
+            try:
+                stream = await client.chat.completions.create(timeout=remaining, stream=True, **kwargs)
+                async for chunk in stream:
+                    received = True
+                    chunks.put(chunk)
+            except Exception as e:
+                if received:
+                    # some of the completion was already yielded: it can't be retried
+                    raise StreamInterrupted(f"DeepSeek stream interrupted: {e}") from e
+                raise
+            chunks.put(_DONE)
+
+        future = self._submit(call, deadline)
+        future.add_done_callback(lambda _: chunks.put(_DONE))
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _DONE:
+                    break
+                yield chunk
+            future.result()
+        finally:
+            future.cancel()
+
+    def stats(self):
+        return {**self.counts, "max_inflight_limit": self.max_inflight, "max_connections": self.max_connections}
+
+    def close(self):
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                if self._client is not None:
+                    asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+def from_env(api_key, base_url):
+    """
+    Builds the client from CHATBRAIN_LLM_MAX_INFLIGHT (calls in flight, default 8),
+    CHATBRAIN_LLM_CONNECTIONS (pooled connections, default 16), CHATBRAIN_LLM_DEADLINE
+    (seconds per call, default 120), CHATBRAIN_LLM_RETRIES (default 4) and
+    CHATBRAIN_LLM_BACKOFF_MS (first backoff, default 500).
+    """
+    return DeepSeekClient(
+        api_key, base_url,
+        max_inflight=int(os.getenv("CHATBRAIN_LLM_MAX_INFLIGHT", 8)),
+        max_connections=int(os.getenv("CHATBRAIN_LLM_CONNECTIONS", 16)),
+        deadline=float(os.getenv("CHATBRAIN_LLM_DEADLINE", 120)),
+        max_retries=int(os.getenv("CHATBRAIN_LLM_RETRIES", 4)),
+        backoff=float(os.getenv("CHATBRAIN_LLM_BACKOFF_MS", 500)) / 1000
+    )
@@ -1,38 +1,126 @@
 # pip3 install transformers
 # python3 deepseek_v2_tokenizer.py
-import transformers
+import functools
+import json
+import math
+import os
+import re
+import threading
 
-def tokenCount(text, chat_tokenizer_dir):
-        """Returns the number of tokens in `text`, based on the tokenizer in `chat_tokenizer_dir`."""
-        tokenizer = transformers.AutoTokenizer.from_pretrained( 
+# input price of deepseek-ai/DeepSeek-V3, in USD
+PRICE_PER_M_TOKENS = 0.14
+
+# Coefficients of the fast estimate, fitted against the real tokenizer by calibrateEstimator
+ESTIMATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "token_estimator.json")
+# used until a calibration is saved: about 4 characters per token, accents and punctuation split more
+DEFAULT_ESTIMATOR = {
+        "coefficients": {"characters": 0.22, "words": 0.15, "non_ascii_bytes": 0.35, "punctuation": 0.3, "intercept": 1.0},
+        "max_relative_error": 0.35
+}
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+_load_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def _load(chat_tokenizer_dir):
+        import transformers
+        return transformers.AutoTokenizer.from_pretrained(
                 chat_tokenizer_dir, trust_remote_code=True
                 )
-        return len(tokenizer.encode(text))
+
+def loadTokenizer(chat_tokenizer_dir):
+        """
+        Returns the tokenizer in `chat_tokenizer_dir`, loaded once per process and shared by all threads.
+        transformers is imported on first use, as it takes seconds to import.
+        """
+        with _load_lock:
+                return _load(chat_tokenizer_dir)
+
+def tokenCount(text, chat_tokenizer_dir):
+        """Returns the number of tokens in `text`, based on the tokenizer in `chat_tokenizer_dir`."""
+        return len(loadTokenizer(chat_tokenizer_dir).encode(text))
+
+def tokenCounts(texts, chat_tokenizer_dir):
+        """Returns the number of tokens of each of `texts`, encoded in one batch."""
+        texts = list(texts)
+        if not texts:
+                return []
+        return [len(ids) for ids in loadTokenizer(chat_tokenizer_dir)(texts)["input_ids"]]
 
 def tokenList(text, chat_tokenizer_dir):
         """Returns the list of tokens in `text`, based on the tokenizer in `chat_tokenizer_dir`."""
-        tokenizer = transformers.AutoTokenizer.from_pretrained(
-                chat_tokenizer_dir, trust_remote_code=True
-                )
-        return tokenizer.encode(text)
+        return loadTokenizer(chat_tokenizer_dir).encode(text)
+
+def estimatorFeatures(text):
+        """Cheap features of `text` the number of tokens is estimated from, all computed in C."""
+        return {
+                "characters": len(text),
+                "words": len(text.split()),
+                "non_ascii_bytes": len(text.encode("utf-8")) - len(text),
+                "punctuation": len(PUNCTUATION.findall(text)),
+                "intercept": 1
+        }
 
-def apiCallPrice(text, outputSize, chat_tokenizer_dir, imageCount=0, imageSizes=[]):
-        """Returns the price of an API call to `deepseek-ai/DeepSeek-V3` for `text`, given a specific `outputSize`."""
+@functools.lru_cache(maxsize=None)
+def loadEstimator(path=ESTIMATOR_PATH):
+        """The calibration saved at `path`, or DEFAULT_ESTIMATOR if there is none."""
+        if not os.path.exists(path):
+                return DEFAULT_ESTIMATOR
+        with open(path, "r") as f:
+                return json.load(f)
+
+def estimateTokens(text, estimator=None):
+        """Estimates the number of tokens in `text` from cheap features, without the tokenizer."""
+        coefficients = (estimator or loadEstimator())["coefficients"]
+        features = estimatorFeatures(text)
+        return max(0, math.ceil(sum(coefficients[name] * value for name, value in features.items())))
+
+def calibrateEstimator(texts, chat_tokenizer_dir, path=ESTIMATOR_PATH):
+        """
+        Fits the estimator's coefficients to the token counts of the real tokenizer on `texts`
+        (least squares), saves them to `path` with the errors of the fit, and returns them.
+        """
+        import numpy as np
+        texts = [text for text in texts if text]
+        names = list(DEFAULT_ESTIMATOR["coefficients"])
+        features = np.array([[estimatorFeatures(text)[name] for name in names] for text in texts], dtype=np.float64)
+        counts = np.array(tokenCounts(texts, chat_tokenizer_dir), dtype=np.float64)
+        solution = np.linalg.lstsq(features, counts, rcond=None)[0]
+        relative_errors = np.abs(features @ solution - counts) / np.maximum(counts, 1)
+        estimator = {
+                "coefficients": {name: float(value) for name, value in zip(names, solution)},
+                "mean_relative_error": float(relative_errors.mean()),
+                # the estimate is trusted for price checks this far from the limit
+                "max_relative_error": float(np.percentile(relative_errors, 99)),
+                "texts": len(texts),
+                "tokenizer": chat_tokenizer_dir
+        }
+        with open(path, "w") as f:
+                json.dump(estimator, f, indent=2)
+        loadEstimator.cache_clear()
+        return estimator
+
+def apiCallPrice(text, outputSize, chat_tokenizer_dir, imageCount=0, imageSizes=[], estimate=False):
+        """
+        Returns the price of an API call to `deepseek-ai/DeepSeek-V3` for `text`, given a specific `outputSize`,
+        and the number of tokens of `text`. With `estimate`, the tokens are estimated instead of counted.
+        """
         # assuming deepseek-ai/DeepSeek-V3 usage
-        price_per_M_tokens = 0.14 # in USD
-        tokens = tokenCount(text, chat_tokenizer_dir) + outputSize
-        return tokens * price_per_M_tokens / 1e6, tokenCount(text, chat_tokenizer_dir)
+        inputTokens = estimateTokens(text) if estimate else tokenCount(text, chat_tokenizer_dir)
+        tokens = inputTokens + outputSize
+        return tokens * PRICE_PER_M_TOKENS / 1e6, inputTokens
 
 if __name__ == "__main__":
         chat_tokenizer_dir = "deepseek-ai/DeepSeek-V3"
-        
+
         def get_string_from_file(file_path):
             with open(file_path, 'r') as file:
                 return file.read()
 
         text = get_string_from_file("../data/shrink_test_output.txt")
         print("Token count: " + str(tokenCount(text, chat_tokenizer_dir)))
+        print("Estimated token count: " + str(estimateTokens(text)))
         tokens = tokenList(text, chat_tokenizer_dir)
         print("Token list: ")
         print(tokens)
-        print("API call price: {:.8f} USD".format(apiCallPrice(text, 1500, chat_tokenizer_dir)))
\ No newline at end of file
+        print("API call price: {:.8f} USD".format(apiCallPrice(text, 1500, chat_tokenizer_dir)[0]))
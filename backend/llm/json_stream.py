@@ -0,0 +1,98 @@
+import json
+
+class FieldStream:
+    """
+    Incremental JSON scanner for the analysis output. Feed it the completion as
+    it is generated and it returns the fields that just became complete, as
+    (path, value) pairs:
+    - every direct child of `top_keys`, e.g. ("conversation_metrics", "trust_asymetry_score") or ("users", "Alice")
+    - every element of an "insights" list, wherever it is nested, e.g. ("users", "insights", 0)
+    Anything before the opening brace of the root object is ignored.
+    """
+
+    def __init__(self, top_keys=("conversation_metrics", "users", "insights")):
+        self.top_keys = top_keys
+        self.buffer = ""
+        self.pos = 0
+        # one frame per open container: {'type': '{' or '[', 'start', 'key', 'index', 'expect_key'}
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.scalar_start = None
+        self.done = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        fields = []
+        while self.pos < len(self.buffer) and not self.done:
+            self._step(self.buffer[self.pos], self.pos, fields)
+            self.pos += 1
+        return fields
+
+    def _path(self):
+        return tuple(frame['key'] if frame['type'] == '{' else frame['index'] for frame in self.stack)
+
+    def _complete(self, start, end, fields):
+        """A value spanning buffer[start:end] just ended, inside the innermost open container."""
+        path = self._path()
+        if len(path) < 2:
+            return
+        nested_insight = path[-2] == "insights"
+        top_level_field = len(path) == 2 and path[0] in self.top_keys and path[1] != "insights"
+        if nested_insight or top_level_field:
+            try:
+                fields.append((path, json.loads(self.buffer[start:end])))
+            except json.JSONDecodeError:
+                pass
+
+    def _end_scalar(self, i, fields):
+        if self.scalar_start is not None:
+            self._complete(self.scalar_start, i, fields)
+            self.scalar_start = None
+
+    def _step(self, c, i, fields):
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif c == '\\':
+                self.escape = True
+            elif c == '"':
+                self.in_string = False
+                frame = self.stack[-1]
+                if frame['type'] == '{' and frame['expect_key']:
+                    frame['key'] = json.loads(self.buffer[self.string_start:i + 1])
+                else:
+                    self._complete(self.string_start, i + 1, fields)
+            return
+
+        if not self.stack:
+            if c == '{':
+                self.stack.append({'type': '{', 'start': i, 'key': None, 'index': 0, 'expect_key': True})
+            return
+
+        frame = self.stack[-1]
+        if c == '"':
+            self.in_string = True
+            self.string_start = i
+        elif c in '{[':
+            self.stack.append({'type': c, 'start': i, 'key': None, 'index': 0, 'expect_key': c == '{'})
+        elif c in '}]':
+            self._end_scalar(i, fields)
+            closed = self.stack.pop()
+            if not self.stack:
+                self.done = True
+            else:
+                self._complete(closed['start'], i + 1, fields)
+        elif c == ':':
+            frame['expect_key'] = False
+        elif c == ',':
+            self._end_scalar(i, fields)
+            if frame['type'] == '{':
+                frame['expect_key'] = True
+            else:
+                frame['index'] += 1
+        elif c.isspace():
+            self._end_scalar(i, fields)
+        elif self.scalar_start is None:
+            self.scalar_start = i
@@ -1,15 +1,48 @@
-from openai import OpenAI
 from dotenv import load_dotenv
+import json
 import os
+import time
 import deepseek_v2_tokenizer as dtok
-import pickle
+from backend import metrics
+import response_cache
+import deepseek_client
+import usage_ledger
 
 load_dotenv()  # Load environment variables from .env file
 model_name = "deepseek-ai/DeepSeek-V3"
-base_url = "https://api.deepseek.com"
+# DEEPSEEK_BASE_URL points the client elsewhere, e.g. at stub_server.py
+base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 
 # usage stats : https://platform.deepseek.com/usage
-client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url=base_url)
+# built by getClient on the first API call, openai being slow to import
+client = None
+
+# Bump whenever getSystemPrompt changes, so cached analyses of the old prompt are not reused
+SYSTEM_PROMPT_VERSION = 2
+analysis_cache = response_cache.from_env()
+# one row per LLM call and cache hit, for GET /usage
+ledger = usage_ledger.from_env()
+
+PRICE_LIMIT = 0.002 # in USD
+# How withinPriceLimit counts the tokens: "exact" with the tokenizer, "estimate" with the fast
+# estimator only, or "auto": estimated, and counted only when the estimate is close to the limit
+TOKEN_COUNT_MODE = os.getenv("CHATBRAIN_TOKEN_COUNT", "exact")
+
+def getClient():
+  global client
+  if client is None:
+    client = deepseek_client.from_env(os.getenv("DEEPSEEK_API_KEY"), base_url)
+  return client
+
+def loadTokenizer():
+  """Loads the tokenizer of the price checks, so that the first analysis doesn't wait for it."""
+  return dtok.loadTokenizer(model_name)
+
+def countTokens(texts):
+  """Token counts of `texts`, counted in one batch or estimated depending on CHATBRAIN_TOKEN_COUNT."""
+  if TOKEN_COUNT_MODE == "exact":
+    return dtok.tokenCounts(texts, model_name)
+  return [dtok.estimateTokens(text) for text in texts]
 
 def calculate_api_cost(chat_completion):
   # Pricing information
@@ -21,8 +54,11 @@ def calculate_api_cost(chat_completion):
   usage = chat_completion.usage
   prompt_tokens = usage.prompt_tokens
   completion_tokens = usage.completion_tokens
-  prompt_cache_hit_tokens = usage.prompt_cache_hit_tokens
-  prompt_cache_miss_tokens = usage.prompt_cache_miss_tokens
+  # DeepSeek-specific fields: without them, count the whole prompt as a miss
+  prompt_cache_hit_tokens = getattr(usage, "prompt_cache_hit_tokens", None) or 0
+  prompt_cache_miss_tokens = getattr(usage, "prompt_cache_miss_tokens", None)
+  if prompt_cache_miss_tokens is None:
+    prompt_cache_miss_tokens = prompt_tokens - prompt_cache_hit_tokens
 
   # Calculate input cost based on cache hit/miss
   input_cost_cache_hit = (prompt_cache_hit_tokens / 1_000_000) * input_price_cache_hit
@@ -37,18 +73,39 @@ def calculate_api_cost(chat_completion):
 
   return total_cost
 
-def getSystemPrompt(users):
-  
-  if users == ["unidentifiable"]:
-    user_details = """Since this file contains no user information, do your best to find the users' names from the prompt.
-      If you absolutely can't, name them User1, User2, etc."""
+def recordUsage(chat_completion, seconds, call, conversation_chars=None):
+  """
+  Per-call telemetry: prompt cache hits and misses, completion tokens, latency and cost of a
+  completion (or of the last chunk of a stream, which holds its usage), in /metrics, the logs
+  and the usage ledger.
+  """
+  usage = chat_completion.usage
+  if usage is None:
+    ledger.record(call, seconds, chat_completion.model, cache="miss", conversation_chars=conversation_chars)
+    return None
+  cost = calculate_api_cost(chat_completion)
+  hit = getattr(usage, "prompt_cache_hit_tokens", None) or 0
+  miss = usage.prompt_tokens - hit
+  metrics.observe_llm_usage(call, seconds, hit, miss, usage.completion_tokens, cost)
+  metrics.log_event("llm_usage", call=call, seconds=round(seconds, 6), prompt_tokens=usage.prompt_tokens,
+                    prompt_cache_hit_tokens=hit, completion_tokens=usage.completion_tokens,
+                    cache_hit_ratio=round(hit / usage.prompt_tokens, 4) if usage.prompt_tokens else None,
+                    cost=round(cost, 8))
+  ledger.record(call, seconds, chat_completion.model, cache="miss", prompt_tokens=usage.prompt_tokens,
+                prompt_cache_hit_tokens=hit, completion_tokens=usage.completion_tokens, cost=cost,
+                conversation_chars=conversation_chars)
+  return cost
 
-  else:
-    user_details = ", ".join([f"{user}" for user in users if user != "unidentifiable"])
+def recordCacheHit(call, start, prompt):
+  """Ledger row of an analysis served from the analysis cache: no tokens, no cost."""
+  ledger.record(call, time.perf_counter() - start, cache="hit", conversation_chars=len(prompt))
 
-  return f"""
+# The instructions are the same for every request and come first, so that DeepSeek serves them
+# from its prompt cache (billed a tenth of the price); the users of the request are appended after them.
+# Keep this string byte-stable: any change, even whitespace, invalidates the cached prefix.
+SYSTEM_PROMPT_PREFIX = """
     Act as a forensic conversation analyst with expertise in microexpression decoding and personality archetype detection. 
-    Perform a multi-layered analysis of this chat between {user_details} using these advanced techniques:
+    Perform a multi-layered analysis of this chat between the users listed at the end of these instructions, using these advanced techniques:
 
     1. **Conversation-level matrix (100pt scales):**
       - Linguistic Synchrony Score: How users subconsciously mirror communication patterns (vocabulary, sentence length, emoji use)
@@ -74,16 +131,16 @@ def getSystemPrompt(users):
 
     IMPOSED OUTPUT JSON FORMAT: 
 
-    {{
-    "conversation_metrics": {{
+    {
+    "conversation_metrics": {
       "linguistic_synchrony_score": int
       "conflict_potential_score": int,
       "trust_asymetry_score": int,
       "temporal_engagement_score": int
-    }},
-    "users": {{
-      // FOR EACH USER in {user_details}
-      username: {{
+    },
+    "users": {
+      // FOR EACH USER listed below
+      username: {
         "emotional_complexity": int,
         "social_perception": int,
         "cognitive_dissonance": int,
@@ -91,52 +148,155 @@ def getSystemPrompt(users):
         "temporal_consistency": int,
         "trust": int
         "conceptual_proficiency": int
-      }},
+      },
       "insights": ["Insight 1", "Insight 2", "Insight 3"]
-    }}
+    }
   """
 
+def getUserDetails(users):
+  if users == ["unidentifiable"]:
+    return """Since this file contains no user information, do your best to find the users' names from the prompt.
+      If you absolutely can't, name them User1, User2, etc."""
+  return "Users in this chat: " + ", ".join([f"{user}" for user in users if user != "unidentifiable"])
+
+def getSystemPrompt(users):
+  return SYSTEM_PROMPT_PREFIX + "\n" + getUserDetails(users)
+
+def withinPriceLimit(prompt, systemPrompt, maxOutputTokens, model_name):
+  """Checks for outstanding prices before making an API call."""
+  with metrics.timed("tokenization"):
+    price, tokenCount = dtok.apiCallPrice(prompt + systemPrompt, maxOutputTokens, model_name,
+                                          estimate=TOKEN_COUNT_MODE != "exact")
+    if TOKEN_COUNT_MODE == "auto":
+      # the estimate is trusted unless the calibration error, relative to the exact count of the
+      # input tokens, could put it on the other side of the limit; the output tokens are exact
+      margin = dtok.loadEstimator().get("max_relative_error", 0.35)
+      outputPrice = maxOutputTokens * dtok.PRICE_PER_M_TOKENS / 1e6
+      inputLimit = PRICE_LIMIT - outputPrice
+      if inputLimit * (1 - margin) < price - outputPrice < inputLimit * (1 + margin):
+        price, tokenCount = dtok.apiCallPrice(prompt + systemPrompt, maxOutputTokens, model_name)
+  metrics.log_event("price_check", tokens=tokenCount, price=round(price, 8), limit=PRICE_LIMIT, mode=TOKEN_COUNT_MODE,
+                    within_limit=price <= PRICE_LIMIT)
+  return price <= PRICE_LIMIT
+
 def promptToJSON(prompt, maxOutputTokens, users=[], model_name="deepseek-ai/DeepSeek-V3"):
+  # identical analyses are served from the cache
+  start = time.perf_counter()
+  key = response_cache.cache_key(prompt, users, SYSTEM_PROMPT_VERSION, maxOutputTokens, "deepseek-chat")
+  cached = analysis_cache.get(key)
+  if cached is not None:
+    recordCacheHit("analysis", start, prompt)
+    from openai.types.chat import ChatCompletion
+    content, response_json = cached
+    return content, ChatCompletion.model_validate_json(response_json)
+
   # build the system prompt
   systemPrompt = getSystemPrompt(users)
 
   #check for outsanding prices, get general token information
-  price, tokenCount = dtok.apiCallPrice(prompt + systemPrompt, maxOutputTokens, model_name)
-  print(f"Token count: {tokenCount}")
-  if price > 0.002:
-    print(f"Warning: This API call will cost ${price:.4f} USD.")
+  if not withinPriceLimit(prompt, systemPrompt, maxOutputTokens, model_name):
     return None, None
     
   # make the API call
   response = api_call("deepseek-chat", maxOutputTokens, prompt, systemPrompt)
   if response.choices[0].message.refusal != None:
-    print("Model refused to answer for the following reason:")
-    print(response.choices[0].message.refusal)
-    return None  
+    # the reason may quote the conversation
+    metrics.log_event("llm_refusal", content={"refusal": response.choices[0].message.refusal})
+    return None, response
   jsonOutput = response.choices[0].message.content
+  analysis_cache.put(key, jsonOutput, response.model_dump_json())
   return jsonOutput, response
 
-def api_call(model, maxOutputTokens, userPrompt, systemPrompt=None):
+def api_call(model, maxOutputTokens, userPrompt, systemPrompt=None, call="analysis"):
+  start = time.perf_counter()
+  try:
+    with metrics.timed("llm_call"):
+      response = getClient().create(
+        model=model,
+        messages=[
+          {"role": "system", "content": systemPrompt},
+          {"role": "user", "content": userPrompt}
+        ],
+        max_tokens=maxOutputTokens,
+        response_format={'type': 'json_object'}
+      )
+  except Exception as e:
+    ledger.record(call, time.perf_counter() - start, model, status=type(e).__name__, cache="miss",
+                  conversation_chars=len(userPrompt))
+    raise
+  recordUsage(response, time.perf_counter() - start, call, len(userPrompt))
+  return (response)
 
-  response = client.chat.completions.create(
-    model=model,
-    messages=[
-      {"role": "system", "content": systemPrompt},
-      {"role": "user", "content": userPrompt}
-    ],
-    max_tokens=maxOutputTokens,
-    response_format={'type': 'json_object'}
-  )
-  # pickle the response object
-  with open("chat_completion.pkl", "wb") as f:
-    pickle.dump(response, f)
+def promptToStream(prompt, maxOutputTokens, users=[], model_name="deepseek-ai/DeepSeek-V3"):
+  """Same checks as promptToJSON, but returns a generator of the completion's text deltas (or None if too expensive)."""
+  start = time.perf_counter()
+  key = response_cache.cache_key(prompt, users, SYSTEM_PROMPT_VERSION, maxOutputTokens, "deepseek-chat")
+  cached = analysis_cache.get(key)
+  if cached is not None:
+    recordCacheHit("stream", start, prompt)
+    return iter([cached[0]])
 
+  systemPrompt = getSystemPrompt(users)
+  if not withinPriceLimit(prompt, systemPrompt, maxOutputTokens, model_name):
+    return None
+  return cacheStream(key, "deepseek-chat", api_call_stream("deepseek-chat", maxOutputTokens, prompt, systemPrompt))
 
+def cacheStream(key, model, deltas):
+  """Forwards the deltas of a streamed completion, and caches it once it is complete and valid JSON."""
+  content = ""
+  # an interrupted stream raises out of the loop, and is not cached
+  for delta in deltas:
+    content += delta
+    yield delta
+  try:
+    json.loads(content)
+  except json.JSONDecodeError:
+    metrics.log_event("stream_not_cached", reason="invalid_json")
+    return
+  # streamed completions have no ChatCompletion object, so store the equivalent one
+  analysis_cache.put(key, content, equivalentCompletion(key, model, content).model_dump_json())
 
-  # with open("chat_completion.pkl", "rb") as f:
-  #   response = pickle.load(f)
+def equivalentCompletion(key, model, content):
+  """A ChatCompletion holding `content`, for the cache entries of analyses not made of one completion."""
+  from openai.types.chat import ChatCompletion
+  return ChatCompletion.model_validate({
+    "id": f"cached-{key[:16]}",
+    "object": "chat.completion",
+    "created": int(time.time()),
+    "model": model,
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}]
+  })
 
-  return (response)
+def api_call_stream(model, maxOutputTokens, userPrompt, systemPrompt=None, call="stream"):
+  """Streaming variant of api_call: yields the content of the completion as it is generated."""
+  start = time.perf_counter()
+  try:
+    stream = getClient().stream(
+      model=model,
+      messages=[
+        {"role": "system", "content": systemPrompt},
+        {"role": "user", "content": userPrompt}
+      ],
+      max_tokens=maxOutputTokens,
+      response_format={'type': 'json_object'},
+      # the last chunk then holds the usage of the whole stream
+      stream_options={'include_usage': True}
+    )
+    for chunk in stream:
+      if chunk.usage is not None:
+        recordUsage(chunk, time.perf_counter() - start, call, len(userPrompt))
+      if not chunk.choices:
+        continue
+      delta = chunk.choices[0].delta
+      if getattr(delta, "refusal", None):
+        raise RuntimeError(f"Model refused to answer: {delta.refusal}")
+      if delta.content:
+        yield delta.content
+  except Exception as e:
+    ledger.record(call, time.perf_counter() - start, model, status=type(e).__name__, cache="miss",
+                  conversation_chars=len(userPrompt))
+    raise
+  metrics.observe("llm_stream", time.perf_counter() - start)
 
 if __name__ == "__main__":
-  print(getSystemPrompt(["Alice", "Bob"], ["A", "B"]))
+  print(getSystemPrompt(["Alice", "Bob"]))
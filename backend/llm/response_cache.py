@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+def normalize_conversation(conversation):
+    """Normalizes line endings and surrounding whitespace, which don't change the analysis."""
+    lines = conversation.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+def cache_key(conversation, users, prompt_version, maxOutputTokens, model):
+    payload = json.dumps([normalize_conversation(conversation), list(users), prompt_version, maxOutputTokens, model])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM analyses. Entries expire after `ttl` seconds, and
+    the least recently used ones are evicted once the stored responses exceed
+    `max_bytes`.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._initialized and os.path.dirname(self.path):
+            # sqlite creates the file, but not its directory
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            with self._lock:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        created REAL NOT NULL,
+                        accessed REAL NOT NULL,
+                        size INTEGER NOT NULL,
+                        content TEXT NOT NULL,
+                        response TEXT NOT NULL
+                    )""")
+                connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+                connection.commit()
+                self._initialized = True
+        return connection
+
+    def get(self, key):
+        """Returns (content, response_json) for `key`, or None if missing or expired."""
+        now = time.time()
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT content, response FROM responses WHERE key = ? AND created > ?",
+                (key, now - self.ttl)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                connection.commit()
+        finally:
+            connection.close()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row
+
+    def put(self, key, content, response_json):
+        now = time.time()
+        size = len(content.encode("utf-8")) + len(response_json.encode("utf-8"))
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, created, accessed, size, content, response) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, now, now, size, content, response_json))
+            self._evict(connection, now)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _evict(self, connection, now):
+        connection.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used entries until we are back under 90% of the cap
+        excess = total - self.max_bytes * 0.9
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if excess <= 0:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            excess -= size
+
+    def stats(self):
+        connection = self._connect()
+        try:
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        finally:
+            connection.close()
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+def from_env():
+    """Builds the cache from the CHATBRAIN_LLM_CACHE_* environment variables."""
+    return ResponseCache(
+        os.getenv("CHATBRAIN_LLM_CACHE_PATH", ".cache/llm_responses.sqlite3"),
+        ttl=int(os.getenv("CHATBRAIN_LLM_CACHE_TTL", 7 * 24 * 3600)),
+        max_bytes=int(os.getenv("CHATBRAIN_LLM_CACHE_MB", 64)) * 1024 * 1024
+    )
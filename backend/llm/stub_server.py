@@ -0,0 +1,193 @@
+"""
+Local stand-in for the DeepSeek chat-completions API, to exercise the client without the
+network or a key: answers POST /chat/completions (streamed or not) after a configurable
+latency, fails a configurable fraction of the calls, and reports the calls it saw in flight
+and the connections they used. Prompt cache hits are imitated on 256-character blocks of
+the prompt prefix, like DeepSeek's context cache.
+
+    python backend/llm/stub_server.py [--port 8099] [--latency-ms 200] [--jitter-ms 100] [--error-rate 0.1] [--error-status 429 503]
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8099 DEEPSEEK_API_KEY=stub python api/api.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CACHE_BLOCK = 256
+DEFAULT_CONTENT = json.dumps({
+    "conversation_metrics": {"linguistic_synchrony_score": 50, "conflict_potential_score": 50,
+                             "trust_asymetry_score": 50, "temporal_engagement_score": 50},
+    "users": {"User1": {"emotional_complexity": 50, "social_perception": 50, "cognitive_dissonance": 50,
+                        "vulnerability_activation": 50, "temporal_consistency": 50, "trust": 50,
+                        "conceptual_proficiency": 50}},
+    "insights": ["Stub insight 1", "Stub insight 2", "Stub insight 3"]
+})
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, as the API does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.rstrip("/") not in ("/chat/completions", "/v1/chat/completions"):
+            return self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+        stub.enter(self.client_address)
+        try:
+            time.sleep(max(0.0, stub.latency + random.uniform(-stub.jitter, stub.jitter)))
+            if random.random() < stub.error_rate:
+                status = random.choice(stub.error_statuses)
+                headers = {"Retry-After": "1"} if status == 429 else {}
+                return self._send_json(status, {"error": {"message": "Injected failure", "type": "server_error"}}, headers)
+            prompt = "".join(message.get("content") or "" for message in body.get("messages", []))
+            if body.get("stream"):
+                self._send_stream(body, prompt)
+            else:
+                self._send_json(200, stub.completion(body, prompt))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up on the call, e.g. past its deadline
+            self.close_connection = True
+        finally:
+            stub.leave()
+
+    def _send_json(self, status, payload, headers={}):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body, prompt):
+        stub = self.server.stub
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        completion = stub.completion(body, prompt)
+        content = completion["choices"][0]["message"]["content"]
+        size = max(1, len(content) // stub.stream_chunks)
+        for start in range(0, len(content), size):
+            chunk = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                     "model": completion["model"],
+                     "choices": [{"index": 0, "delta": {"content": content[start:start + size]}, "finish_reason": None}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            time.sleep(stub.stream_interval)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                     "model": completion["model"], "choices": [], "usage": completion["usage"]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class StubServer:
+    """The stub on `host`:`port` (0 picks a free port), served from a background thread by start()."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.2, jitter=0.1, error_rate=0.0, error_statuses=(429, 500, 503),
+                 content=DEFAULT_CONTENT, stream_chunks=8, stream_interval=0.01):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.content = content
+        self.stream_chunks = stream_chunks
+        self.stream_interval = stream_interval
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._lock = threading.Lock()
+        self._prefixes = set()
+        self.counts = {"requests": 0, "inflight": 0, "max_inflight": 0}
+        self.connections = set()
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def enter(self, client_address):
+        with self._lock:
+            self.counts["requests"] += 1
+            self.counts["inflight"] += 1
+            self.counts["max_inflight"] = max(self.counts["max_inflight"], self.counts["inflight"])
+            self.connections.add(client_address)
+
+    def leave(self):
+        with self._lock:
+            self.counts["inflight"] -= 1
+
+    def cached_characters(self, prompt):
+        """Length of the prompt prefix already seen, in whole blocks, and remembers this prompt's blocks."""
+        digest = hashlib.sha256()
+        hit = 0
+        with self._lock:
+            for end in range(CACHE_BLOCK, len(prompt) + 1, CACHE_BLOCK):
+                digest.update(prompt[end - CACHE_BLOCK:end].encode("utf-8"))
+                key = digest.hexdigest()
+                if key in self._prefixes and hit == end - CACHE_BLOCK:
+                    hit = end
+                self._prefixes.add(key)
+        return hit
+
+    def completion(self, body, prompt):
+        # about 4 characters per token
+        prompt_tokens = max(1, len(prompt) // 4)
+        hit_tokens = min(prompt_tokens, self.cached_characters(prompt) // 4)
+        completion_tokens = max(1, len(self.content) // 4)
+        return {
+            "id": f"stub-{random.getrandbits(48):012x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "deepseek-chat"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": self.content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_cache_hit_tokens": hit_tokens, "prompt_cache_miss_tokens": prompt_tokens - hit_tokens}
+        }
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, "connections": len(self.connections)}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="stub-server").start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, nargs="+", default=[429, 500, 503])
+    parser.add_argument("--content", help="file holding the completion to answer with")
+    args = parser.parse_args()
+    content = open(args.content, encoding="utf-8").read() if args.content else DEFAULT_CONTENT
+    stub = StubServer(args.host, args.port, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate,
+                      tuple(args.error_status), content)
+    print(f"DeepSeek stub listening on {stub.base_url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,186 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from backend import metrics
+
+COLUMNS = ("time", "call", "model", "status", "cache", "prompt_tokens", "prompt_cache_hit_tokens",
+           "completion_tokens", "latency", "cost", "conversation_chars")
+
+def percentile(values, p):
+    """Nearest-rank percentile of `values`, None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+class UsageLedger:
+    """
+    Append-only SQLite ledger of the LLM usage, one row per call: its tokens, latency and
+    cost, whether the analysis cache answered it, and the size of the conversation. Rows are
+    queued by record() and written in batches by a background thread, every
+    `flush_interval` seconds or `batch_size` rows, so requests never wait for the disk.
+    Past `max_pending` queued rows, new ones are dropped and counted, as are rows that
+    could not be written.
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=1.0, max_pending=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._writer = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized and os.path.dirname(self.path):
+            # sqlite creates the file, but not its directory
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            with self._lock:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS usage (
+                        id INTEGER PRIMARY KEY,
+                        time REAL NOT NULL,
+                        call TEXT NOT NULL,
+                        model TEXT,
+                        status TEXT NOT NULL,
+                        cache TEXT,
+                        prompt_tokens INTEGER NOT NULL,
+                        prompt_cache_hit_tokens INTEGER NOT NULL,
+                        completion_tokens INTEGER NOT NULL,
+                        latency REAL NOT NULL,
+                        cost REAL NOT NULL,
+                        conversation_chars INTEGER
+                    )""")
+                connection.execute("CREATE INDEX IF NOT EXISTS usage_time ON usage (time)")
+                connection.commit()
+                self._initialized = True
+        return connection
+
+    def _start(self):
+        """The writer thread, started on first use (in each process, as it doesn't survive a fork)."""
+        with self._lock:
+            if self._writer is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._writer = threading.Thread(target=self._write_batches, daemon=True, name="usage-ledger")
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def record(self, call, latency, model=None, status="ok", cache=None, prompt_tokens=0, prompt_cache_hit_tokens=0,
+               completion_tokens=0, cost=0.0, conversation_chars=None):
+        """Queues one row; `cache` is "hit" when the analysis cache answered, "miss" when the LLM did."""
+        self._start()
+        row = (time.time(), call, model, status, cache, prompt_tokens, prompt_cache_hit_tokens,
+               completion_tokens, latency, cost, conversation_chars)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_batches(self):
+        connection = None
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # None is put by flush(): the partial batch is written right away
+            while len(rows) < self.batch_size and rows[-1] is not None:
+                try:
+                    rows.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            batch = [row for row in rows if row is not None]
+            try:
+                if not batch:
+                    continue
+                # connected again after a failure, so that the writer outlives an unwritable path
+                connection = connection or self._connect()
+                connection.executemany(f"INSERT INTO usage ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", batch)
+                connection.commit()
+            except (sqlite3.Error, OSError) as e:
+                self.dropped += len(batch)
+                metrics.logger.warning(f"Usage ledger: could not write {len(batch)} rows to {self.path}: {e}")
+                if connection is not None:
+                    connection.close()
+                connection = None
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def flush(self, timeout=5.0):
+        """Waits until the queued rows are written, at most `timeout` seconds."""
+        if self._writer is None or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        end = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < end:
+            time.sleep(0.01)
+
+    def aggregate(self, window=3600, since=None, until=None, call=None):
+        """
+        Usage per `window` seconds between `since` and `until` (default: the last 24 hours), and in
+        total: calls, analysis-cache hits, errors, tokens, cost and LLM latency percentiles.
+        """
+        self.flush(timeout=1.0)
+        until = until or time.time()
+        since = since or until - 24 * 3600
+        query = "SELECT time, status, cache, prompt_tokens, prompt_cache_hit_tokens, completion_tokens, latency, cost FROM usage WHERE time >= ? AND time < ?"
+        parameters = [since, until]
+        if call:
+            query += " AND call = ?"
+            parameters.append(call)
+        connection = self._connect()
+        try:
+            rows = connection.execute(query + " ORDER BY time", parameters).fetchall()
+        finally:
+            connection.close()
+        buckets = {}
+        for row in rows:
+            buckets.setdefault(int((row[0] - since) // window), []).append(row)
+        return {
+            "since": since,
+            "until": until,
+            "window": window,
+            "buckets": [{"start": since + index * window, **self._summarize(bucket)} for index, bucket in sorted(buckets.items())],
+            "total": self._summarize(rows),
+            "dropped": self.dropped
+        }
+
+    @staticmethod
+    def _summarize(rows):
+        # latencies of the calls the LLM answered: cache hits and errors would skew them
+        latencies = [row[6] for row in rows if row[2] != "hit" and row[1] == "ok"]
+        prompt_tokens = sum(row[3] for row in rows)
+        cache_hit_tokens = sum(row[4] for row in rows)
+        return {
+            "calls": len(rows),
+            "llm_calls": sum(row[2] != "hit" for row in rows),
+            "cache_hits": sum(row[2] == "hit" for row in rows),
+            "errors": sum(row[1] != "ok" for row in rows),
+            "prompt_tokens": prompt_tokens,
+            "prompt_cache_hit_tokens": cache_hit_tokens,
+            "prompt_cache_hit_ratio": round(cache_hit_tokens / prompt_tokens, 4) if prompt_tokens else None,
+            "completion_tokens": sum(row[5] for row in rows),
+            "cost": round(sum(row[7] for row in rows), 8),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95)
+        }
+
+
+def from_env():
+    """Builds the ledger from CHATBRAIN_USAGE_LEDGER_PATH (default .cache/llm_usage.sqlite3) and CHATBRAIN_USAGE_FLUSH_MS (default 1000)."""
+    return UsageLedger(
+        os.getenv("CHATBRAIN_USAGE_LEDGER_PATH", ".cache/llm_usage.sqlite3"),
+        flush_interval=float(os.getenv("CHATBRAIN_USAGE_FLUSH_MS", 1000)) / 1000
+    )
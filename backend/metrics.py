@@ -0,0 +1,147 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from backend.histogram import Histogram, TIME_BUCKETS
+
+# Stage timings of the request being served; the dict is shared with the threads it starts (see vision/pipeline.py)
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+logger = logging.getLogger("chatbrain")
+
+
+class HistogramFamily:
+    """Histograms of one metric, one per value of its label, exported in the Prometheus text format."""
+
+    def __init__(self, name, help, label, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value):
+        histogram = self.histograms.get(label_value)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(label_value, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, histogram in sorted(self.histograms.items()):
+            snapshot = histogram.snapshot()
+            label = f'{self.label}="{label_value}"'
+            for le, count in snapshot["buckets"]:
+                lines.append(f'{self.name}_bucket{{{label},le="{le}"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {snapshot['sum']}")
+            lines.append(f"{self.name}_count{{{label}}} {snapshot['count']}")
+        return "\n".join(lines)
+
+
+class CounterFamily:
+    """Counters of one metric, one per value of its label, exported in the Prometheus text format."""
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value, label_value):
+        with self._lock:
+            self.counts[label_value] = self.counts.get(label_value, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_value, count in sorted(self.counts.items()):
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {count}')
+        return "\n".join(lines)
+
+
+STAGES = HistogramFamily("chatbrain_stage_seconds", "Time spent in each stage of the analysis pipeline.", "stage")
+REQUESTS = HistogramFamily("chatbrain_request_seconds", "Time spent serving each endpoint.", "endpoint")
+# DeepSeek usage, per kind of call (analysis, stream, synthesis)
+LLM_TOKENS = CounterFamily("chatbrain_llm_tokens_total", "DeepSeek tokens by kind: prompt cache hits and misses, and completion.", "kind")
+LLM_COST = CounterFamily("chatbrain_llm_cost_usd_total", "DeepSeek spend in USD, per kind of call.", "call")
+LLM_CACHE_HIT_RATIO = HistogramFamily("chatbrain_llm_prompt_cache_hit_ratio", "Fraction of each call's prompt tokens served from the DeepSeek prompt cache.",
+                                      "call", buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1))
+ENCODING_TOKENS = CounterFamily("chatbrain_llm_encoding_tokens_total", "Conversation tokens before (input) and after (encoded) the LLM encoding.", "stage")
+LLM_SECONDS = HistogramFamily("chatbrain_llm_call_seconds", "DeepSeek call latency, per kind of call.", "call")
+
+def observe(stage, seconds):
+    """Records `seconds` spent in `stage`, in its histogram and in the timings of the current request."""
+    STAGES.observe(seconds, stage)
+    stages = _request_stages.get()
+    if stages is not None:
+        with stages["lock"]:
+            total, count = stages["timings"].get(stage, (0.0, 0))
+            stages["timings"][stage] = (total + seconds, count + 1)
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def begin_request():
+    """Starts collecting the stage timings of the request served by this thread."""
+    _request_stages.set({"lock": threading.Lock(), "timings": {}, "start": time.perf_counter()})
+
+def end_request(endpoint):
+    """Records the request time of `endpoint` and returns the stage timings of the request: {stage: {"seconds", "count"}}."""
+    stages = _request_stages.get()
+    _request_stages.set(None)
+    if stages is None:
+        return None, {}
+    seconds = time.perf_counter() - stages["start"]
+    REQUESTS.observe(seconds, endpoint)
+    with stages["lock"]:
+        timings = {stage: {"seconds": round(total, 6), "count": count} for stage, (total, count) in stages["timings"].items()}
+    return seconds, timings
+
+def observe_llm_usage(call, seconds, prompt_cache_hit_tokens, prompt_cache_miss_tokens, completion_tokens, cost):
+    """Records the usage of one DeepSeek call of kind `call`."""
+    LLM_TOKENS.inc(prompt_cache_hit_tokens, "prompt_cache_hit")
+    LLM_TOKENS.inc(prompt_cache_miss_tokens, "prompt_cache_miss")
+    LLM_TOKENS.inc(completion_tokens, "completion")
+    LLM_COST.inc(cost, call)
+    LLM_SECONDS.observe(seconds, call)
+    prompt_tokens = prompt_cache_hit_tokens + prompt_cache_miss_tokens
+    if prompt_tokens:
+        LLM_CACHE_HIT_RATIO.observe(prompt_cache_hit_tokens / prompt_tokens, call)
+
+def render():
+    """Every histogram in the Prometheus text exposition format."""
+    families = (STAGES, REQUESTS, LLM_TOKENS, LLM_COST, LLM_CACHE_HIT_RATIO, LLM_SECONDS, ENCODING_TOKENS)
+    return "\n".join(family.render() for family in families) + "\n"
+
+
+# Structured logs: one JSON object per line on the "chatbrain" logger, only with CHATBRAIN_STRUCTURED_LOGS=1.
+# Conversations and metadata are only included with CHATBRAIN_LOG_CONVERSATIONS=1.
+STRUCTURED_LOGS = os.getenv("CHATBRAIN_STRUCTURED_LOGS", "0") == "1"
+LOG_CONVERSATIONS = os.getenv("CHATBRAIN_LOG_CONVERSATIONS", "0") == "1"
+
+if STRUCTURED_LOGS and not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def log_event(event, content=None, **fields):
+    """Logs `event` with `fields`; `content` (conversations, metadata) is only logged with CHATBRAIN_LOG_CONVERSATIONS=1."""
+    if not STRUCTURED_LOGS:
+        return
+    record = {"event": event, "time": round(time.time(), 3), **fields}
+    if LOG_CONVERSATIONS and content is not None:
+        record["content"] = content
+    logger.info(json.dumps(record, default=str))
@@ -0,0 +1,152 @@
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+# Threads working for the profiled request: the request's own, and the pipeline stages it starts
+_profiled_threads = contextvars.ContextVar("profiled_threads", default=None)
+
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+def register_thread():
+    """Called by threads started for a request, so that they are sampled with it when it is profiled."""
+    threads = _profiled_threads.get()
+    if threads is not None:
+        threads[threading.get_ident()] = threading.current_thread().name
+
+def collapse(frame):
+    """The stack of `frame` in the folded format of flamegraph.pl, root first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profile:
+    """
+    Samples the stacks of the threads of one request every `interval` seconds, and
+    tracks its allocation peak with tracemalloc. stop() writes the folded stacks
+    (<id>.folded, for flamegraph.pl or speedscope) and a summary (<id>.json) to
+    `directory`, keeping only the `keep` most recent profiles.
+    """
+
+    def __init__(self, label, directory, keep=50, interval=0.005):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.label = label
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self.threads = {threading.get_ident(): threading.current_thread().name}
+        _profiled_threads.set(self.threads)
+        self._stopped = threading.Event()
+        self._start_tracemalloc()
+        self.started = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, daemon=True, name="profile-sampler")
+        self._sampler.start()
+
+    def _start_tracemalloc(self):
+        global _tracemalloc_users
+        with _tracemalloc_lock:
+            if _tracemalloc_users == 0:
+                tracemalloc.start()
+            # the peak is process-wide: with overlapping profiled requests it covers all of them
+            tracemalloc.reset_peak()
+            _tracemalloc_users += 1
+
+    def _stop_tracemalloc(self):
+        global _tracemalloc_users
+        with _tracemalloc_lock:
+            _, peak = tracemalloc.get_traced_memory()
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0:
+                tracemalloc.stop()
+        return peak
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[f"{name};{collapse(frame)}"] += 1
+            self.sample_count += 1
+
+    def stop(self, **summary):
+        """Stops sampling, writes the profile and returns its summary. `summary` adds fields to it."""
+        self._stopped.set()
+        self._sampler.join()
+        seconds = time.perf_counter() - self.started
+        peak = self._stop_tracemalloc()
+        _profiled_threads.set(None)
+        summary = {
+            "id": self.id,
+            "label": self.label,
+            "seconds": round(seconds, 6),
+            "samples": self.sample_count,
+            "interval": self.interval,
+            "tracemalloc_peak_bytes": peak,
+            **summary
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, self.id + ".folded"), "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+        with open(os.path.join(self.directory, self.id + ".json"), "w") as f:
+            json.dump(summary, f)
+        self._evict()
+        return summary
+
+    def _evict(self):
+        profiles = [name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json")]
+        profiles.sort(key=lambda profile: os.path.getmtime(os.path.join(self.directory, profile + ".json")))
+        for old in profiles[:max(0, len(profiles) - self.keep)]:
+            for extension in (".folded", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, old + extension))
+                except FileNotFoundError:
+                    pass
+
+
+class Profiler:
+    """Decides which requests are profiled: those asking for it with a header, and a `sample_rate` fraction of the others."""
+
+    def __init__(self, enabled=False, sample_rate=0.0, directory=".cache/profiles", keep=50, interval_ms=5):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval_ms / 1000
+
+    def wanted(self, header_value=None):
+        if not self.enabled:
+            return False
+        return header_value == "1" or random.random() < self.sample_rate
+
+    def start(self, label):
+        return Profile(label, self.directory, self.keep, self.interval)
+
+
+def from_env():
+    """
+    Builds the profiler from CHATBRAIN_PROFILING (1 to allow profiling at all),
+    CHATBRAIN_PROFILE_SAMPLE_RATE (fraction of requests, default 0), CHATBRAIN_PROFILE_DIR
+    (default .cache/profiles), CHATBRAIN_PROFILE_KEEP (profiles kept, default 50) and
+    CHATBRAIN_PROFILE_INTERVAL_MS (default 5).
+    """
+    return Profiler(
+        enabled=os.getenv("CHATBRAIN_PROFILING", "0") == "1",
+        sample_rate=float(os.getenv("CHATBRAIN_PROFILE_SAMPLE_RATE", 0)),
+        directory=os.getenv("CHATBRAIN_PROFILE_DIR", ".cache/profiles"),
+        keep=int(os.getenv("CHATBRAIN_PROFILE_KEEP", 50)),
+        interval_ms=float(os.getenv("CHATBRAIN_PROFILE_INTERVAL_MS", 5))
+    )
@@ -0,0 +1,92 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from backend.histogram import Histogram
+
+class BatchScheduler:
+    """
+    Stand-in for the YOLO model that merges images from concurrent callers into
+    batched forward passes. A call blocks until its images went through the
+    model and returns one result per image, like calling the model directly.
+    A batch is run as soon as it holds `max_batch_size` images, or `max_wait_ms`
+    after its first image was queued.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=15):
+        self.model = model
+        self.imgsz = getattr(model, "imgsz", 640)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = Histogram(buckets=(1, 2, 4, 8, 16, 32, 64))
+        self.queue_wait = Histogram(buckets=(0.001, 0.0025, 0.005, 0.01, 0.015, 0.025, 0.05, 0.1, 0.25, 1, 5))
+        self.inference_time = Histogram()
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # threads don't survive a fork, so every process starts its own worker
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True, name="yolo-batcher").start()
+            return self._queue
+
+    def __call__(self, images):
+        pending = self._ensure_worker()
+        futures = []
+        for image in images:
+            future = Future()
+            pending.put((image, time.monotonic(), future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _next_batch(self, pending):
+        batch = [pending.get()]
+        deadline = batch[0][1] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, pending):
+        while True:
+            batch = self._next_batch(pending)
+            started = time.monotonic()
+            for _, queued, _ in batch:
+                self.queue_wait.observe(started - queued)
+            self.batch_sizes.observe(len(batch))
+            try:
+                results = self.model([image for image, _, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.inference_time.observe(time.monotonic() - started)
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+            "inference_seconds": self.inference_time.snapshot()
+        }
+
+
+def from_env(model):
+    """Wraps `model` with the CHATBRAIN_BATCH_SIZE and CHATBRAIN_BATCH_WAIT_MS settings."""
+    return BatchScheduler(
+        model,
+        max_batch_size=int(os.getenv("CHATBRAIN_BATCH_SIZE", 8)),
+        max_wait_ms=float(os.getenv("CHATBRAIN_BATCH_WAIT_MS", 15))
+    )
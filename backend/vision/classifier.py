@@ -1,5 +1,6 @@
-from ultralytics import YOLO
 from PIL import Image
+import numpy as np
+from backend import metrics
 # from backend.vision.ocr import extract_text_from_boxes
 
 def xywhn_to_xyxy(xywhn):
@@ -22,76 +23,167 @@ def overlap_fractions(boxA, boxB):
     areaB = (x2B - x1B) * (y2B - y1B)
     return (interArea / areaA if areaA else 0, interArea / areaB if areaB else 0)
 
-def getBoxesFromImages(images, visionModel):
-    results = visionModel(images)
+def overlap_fraction_arrays(boxesA, boxesB):
+    """Vectorized overlap_fractions between two (n, 4) arrays of xyxy boxes, pair by pair."""
+    interW = np.minimum(boxesA[:, 2], boxesB[:, 2]) - np.maximum(boxesA[:, 0], boxesB[:, 0])
+    interH = np.minimum(boxesA[:, 3], boxesB[:, 3]) - np.maximum(boxesA[:, 1], boxesB[:, 1])
+    interArea = np.where((interW > 0) & (interH > 0), interW * interH, 0.0)
+    areaA = (boxesA[:, 2] - boxesA[:, 0]) * (boxesA[:, 3] - boxesA[:, 1])
+    areaB = (boxesB[:, 2] - boxesB[:, 0]) * (boxesB[:, 3] - boxesB[:, 1])
+    fracA = np.divide(interArea, areaA, out=np.zeros(len(interArea)), where=areaA != 0)
+    fracB = np.divide(interArea, areaB, out=np.zeros(len(interArea)), where=areaB != 0)
+    return fracA, fracB
+
+def overlapping_pairs(xyxy, overlap_threshold):
     """
-    Process YOLO results into custom format while preserving visualization capability,
-    then remove any box that overlaps more than 20% with a higher-confidence box.
+    Returns the pairs (a, b) of boxes where one covers more than `overlap_threshold`
+    of the other's area. Only pairs whose vertical extents intersect are compared,
+    found with a sort on the top edges, so long captures don't cost n² comparisons.
     """
+    byTop = np.argsort(xyxy[:, 1], kind="stable")
+    tops = xyxy[byTop, 1]
+    # the boxes after position p that start above the bottom of box p
+    ends = np.searchsorted(tops, xyxy[byTop, 3], side="left")
+    counts = np.maximum(ends - np.arange(len(byTop)) - 1, 0)
+    first = np.repeat(np.arange(len(byTop)), counts)
+    second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    a, b = byTop[first], byTop[second]
+    fracA, fracB = overlap_fraction_arrays(xyxy[a], xyxy[b])
+    overlapping = (fracA > overlap_threshold) | (fracB > overlap_threshold)
+    return a[overlapping], b[overlapping]
 
-    processed_results = []
-    for r in results:
-        boxes = r.boxes
-        raw_boxes = []
-        oneSided = True
-        leftMin = 1
-        leftMax = 0
+def processBoxes(xywhn, conf, cls, overlap_threshold=0.2, truncated=None):
+    """
+    Turns the raw detections of one image (arrays of xywhn, confidence and class)
+    into the custom box format, then removes any box that overlaps more than 20%
+    with a higher-confidence box. Everything but building the output dicts runs
+    as array operations.
+    Boxes flagged in `truncated` (cut by a tile edge) rank after all complete boxes,
+    so that the complete copy of a bubble wins over its cut-off copy.
+    """
+    xywhn = np.round(np.asarray(xywhn, dtype=np.float64).reshape(-1, 4), 5)
+    conf = np.round(np.asarray(conf, dtype=np.float64).reshape(-1), 2)
+    cls = np.asarray(cls).reshape(-1).astype(int)
+    xyxy = np.concatenate([xywhn[:, :2] - xywhn[:, 2:] / 2, xywhn[:, :2] + xywhn[:, 2:] / 2], axis=1)
 
-        for box in boxes:
-            xywhn = [round(x, 5) for x in box.xywhn[0].cpu().tolist()]
-            conf = round(box.conf.cpu().item(), 2)
-            cls_id = int(box.cls.cpu().item())
-            x_center = xywhn[0]
-            pos_class = 1 if x_center > 0.5 else 0
+    # One sided is true if all boxes' left edges are less than 0.1 apart
+    leftEdges = xyxy[cls != 2, 0]
+    oneSided = True
+    if len(leftEdges):
+        oneSided = not (max(0, leftEdges.max()) - min(1, leftEdges.min()) > 0.1)
 
-            # One sided is true if all boxes' left edges are less than 0.1 apart
-            leftEdge = x_center - xywhn[2]/2
-            if cls_id != 2:
-                leftMin = min(leftMin, leftEdge)
-                leftMax = max(leftMax, leftEdge)
-                if leftMax - leftMin > 0.1:
-                    oneSided = False
+    # Filter overlapping boxes: a box is dropped if it overlaps a kept box of higher or equal conf
+    if truncated is None:
+        order = np.argsort(-conf, kind="stable")
+    else:
+        order = np.lexsort((-conf, np.asarray(truncated, dtype=bool)))
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    neighbors = [[] for _ in order]
+    for a, b in zip(*(pair.tolist() for pair in overlapping_pairs(xyxy, overlap_threshold))):
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+    suppressed = np.zeros(len(order), dtype=bool)
+    kept = []
+    for i in order.tolist():
+        if suppressed[i]:
+            continue
+        kept.append(i)
+        for j in neighbors[i]:
+            if rank[j] > rank[i]:
+                suppressed[j] = True
 
-            raw_boxes.append({
-                'xywhn': xywhn,
-                'conf': conf,
-                'cls': cls_id,
-                'posClass': pos_class
-            })
+    # Sort final boxes by Y center for convenience
+    kept = np.array(kept, dtype=int)
+    kept = kept[np.argsort(xywhn[kept, 1], kind="stable")]
+    return {
+        'boxes': [{
+            'xywhn': xywhn[i].tolist(),
+            'conf': float(conf[i]),
+            'cls': int(cls[i]),
+            'posClass': 1 if xywhn[i, 0] > 0.5 else 0
+        } for i in kept],
+        'oneSided': oneSided,
+    }
 
-        # Filter overlapping boxes
-        raw_boxes.sort(key=lambda b: b['conf'], reverse=True)
-        final_boxes = []
-        for b in raw_boxes:
-            skip_box = False
-            for fb in final_boxes:
-                fracA, fracB = overlap_fractions(b, fb)
-                if fracA > 0.2 or fracB > 0.2:
-                    # fb has higher or equal conf since final_boxes is sorted descending
-                    skip_box = True
-                    break
-            if not skip_box:
-                final_boxes.append(b)
+# Images taller than TILE_THRESHOLD times their width are cut into tiles TILE_ASPECT times as tall as wide
+TILE_ASPECT = 2.2
+TILE_THRESHOLD = 3.0
 
-        # Sort final boxes by Y center for convenience
-        final_boxes.sort(key=lambda x: x['xywhn'][1])
-        processed_results.append({
-            'boxes': final_boxes,
-            'oneSided': oneSided,
-        })
+def tileImage(image, tile_aspect=TILE_ASPECT, tile_overlap=0.25):
+    """
+    Cuts a tall image into full-width horizontal tiles of `tile_aspect` * width
+    pixels, overlapping by `tile_overlap` of a tile. The tiles are views into the
+    image (whole rows, so they stay contiguous). Returns (tiles, tile top rows).
+    """
+    height, width = image.shape[:2]
+    tile_height = int(width * tile_aspect)
+    if height <= tile_height:
+        return [image], [0]
+    step = max(1, int(tile_height * (1 - tile_overlap)))
+    starts = list(range(0, height - tile_height, step)) + [height - tile_height]
+    return [image[start:start + tile_height] for start in starts], starts
 
+def getBoxesFromImages(images, visionModel, tiled=False, tile_aspect=TILE_ASPECT, tile_overlap=0.25, tile_threshold=TILE_THRESHOLD, edge_margin=0.01):
+    """
+    Process YOLO results into custom format while preserving visualization capability,
+    then remove any box that overlaps more than 20% with a higher-confidence box.
+    With `tiled`, images taller than `tile_threshold` times their width (long scrolling
+    captures) are cut with tileImage and all tiles are inferred in one batch. Each tile is
+    still letterboxed to the model's input size, but on its own, so the text is shrunk far
+    less than when the whole capture is. Tile boxes are mapped back to the image's xywhn,
+    and the duplicates found in overlap bands are merged by the overlap filter.
+    """
+    # (image index, tile top row, tile height, image height) for each model input
+    inputs, origins = [], []
+    for index, image in enumerate(images):
+        if tiled and isinstance(image, np.ndarray) and image.shape[0] > image.shape[1] * tile_threshold:
+            tiles, starts = tileImage(image, tile_aspect, tile_overlap)
+            inputs += tiles
+            origins += [(index, start, tile.shape[0], image.shape[0]) for tile, start in zip(tiles, starts)]
+        else:
+            inputs.append(image)
+            origins.append((index, 0, None, None))
+
+    with metrics.timed("detection"):
+        results = visionModel(inputs)
+    detections = [([], [], [], []) for _ in images]
+    for r, (index, start, tile_height, height) in zip(results, origins):
+        # pull the whole tensors off the device once, rather than once per box
+        xywhn = r.boxes.xywhn.cpu().numpy().astype(np.float64).reshape(-1, 4)
+        truncated = np.zeros(len(xywhn), dtype=bool)
+        if tile_height is not None:
+            # a box touching a cut between two tiles is only part of a bubble
+            top, bottom = xywhn[:, 1] - xywhn[:, 3] / 2, xywhn[:, 1] + xywhn[:, 3] / 2
+            truncated = ((top < edge_margin) & (start > 0)) | ((bottom > 1 - edge_margin) & (start + tile_height < height))
+            xywhn[:, 1] = (start + xywhn[:, 1] * tile_height) / height
+            xywhn[:, 3] = xywhn[:, 3] * tile_height / height
+        for values, array in zip(detections[index], (xywhn, r.boxes.conf.cpu().numpy(), r.boxes.cls.cpu().numpy(), truncated)):
+            values.append(array)
+
+    processed_results = []
+    with metrics.timed("box_filtering"):
+        for xywhn, conf, cls, truncated in detections:
+            processed_results.append(processBoxes(
+                np.concatenate(xywhn),
+                np.concatenate(conf),
+                np.concatenate(cls),
+                truncated=np.concatenate(truncated) if len(truncated) > 1 else None
+            ))
     return processed_results
 
 # Usage example
 if __name__ == "__main__":
-    model = YOLO("backend/vision/best.pt")
-    device = next(model.parameters()).device
-    print(f"Inference is running on device: {device}")
+    from detector import from_env
+    # CHATBRAIN_DETECTOR_BACKEND / CHATBRAIN_DETECTOR_IMGSZ select the backend, like in api/api.py
+    detector = from_env("backend/vision/best.pt")
+    model = detector.load()
+    print(f"Inference is running on backend: {detector.name}")
     
     image_paths = ["backend/vision/dataset/raw/why-did-alexa-stop-talking-to-me-she-seemed-nice-v0-xxaq456yw7ce1.webp"]
 
     # 3. Get processed data
-    processed_results = getBoxesFromImages(image_paths, model)
+    processed_results = getBoxesFromImages(image_paths, detector)
     from ocr import extract_text_from_boxes
     
     # Display bounding boxes using built-in ultralytics function
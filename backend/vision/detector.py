@@ -0,0 +1,95 @@
+import argparse
+import os
+import threading
+import time
+
+# "torch" runs best.pt eagerly; "onnx" (ONNX Runtime) and "openvino" run a model exported from it
+DETECTOR_BACKENDS = ("torch", "onnx", "openvino")
+
+def exported_path(weights, backend, int8=False):
+    """Where export_detector writes the `backend` version of `weights` (ultralytics' naming)."""
+    stem = os.path.splitext(weights)[0] + ("_int8" if int8 else "")
+    if backend == "onnx":
+        return stem + ".onnx"
+    if backend == "openvino":
+        return stem + "_openvino_model"
+    return weights
+
+def export_detector(weights, backend, imgsz=640, int8=False, data="backend/vision/chat_dataset.yaml"):
+    """
+    Exports `weights` for a CPU runtime, with dynamic batch and input sizes.
+    INT8 is post-training dynamic quantization with onnxruntime for ONNX, and
+    calibrated on the `data` dataset by ultralytics/NNCF for OpenVINO.
+    """
+    from ultralytics import YOLO
+    model = YOLO(weights)
+    if backend == "onnx":
+        path = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+        if int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(path, exported_path(weights, backend, int8), weight_type=QuantType.QUInt8)
+            path = exported_path(weights, backend, int8)
+    elif backend == "openvino":
+        path = model.export(format="openvino", imgsz=imgsz, dynamic=True, int8=int8, data=data if int8 else None)
+    else:
+        raise ValueError(f"Nothing to export for backend {backend}, expected one of {DETECTOR_BACKENDS[1:]}")
+    return path
+
+
+class Detector:
+    """
+    Callable like the YOLO model it wraps, whatever the backend, at a fixed inference size.
+    The model (and ultralytics, torch with it) is loaded on the first call, or by load().
+    """
+
+    def __init__(self, weights, backend="torch", imgsz=640, int8=False):
+        if backend not in DETECTOR_BACKENDS:
+            raise ValueError(f"Unknown detector backend {backend}, expected one of {DETECTOR_BACKENDS}")
+        path = exported_path(weights, backend, int8)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, export it with: python backend/vision/detector.py --backend {backend}{' --int8' if int8 else ''}")
+        self.path = path
+        self.model = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+        self.backend = backend
+        self.imgsz = imgsz
+        self.int8 = int8
+        # identifies the detector in caches, as backends and input sizes give slightly different boxes
+        self.name = f"{backend}{'-int8' if int8 else ''}-{imgsz}"
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        with self._lock:
+            if self.model is None:
+                from ultralytics import YOLO
+                start = time.perf_counter()
+                self.model = YOLO(self.path, task="detect")
+                self.load_seconds = time.perf_counter() - start
+        return self.model
+
+    def __call__(self, images):
+        return self.load()(images, imgsz=self.imgsz)
+
+
+def from_env(weights):
+    """Builds the detector from CHATBRAIN_DETECTOR_BACKEND, CHATBRAIN_DETECTOR_IMGSZ and CHATBRAIN_DETECTOR_INT8."""
+    return Detector(
+        weights,
+        backend=os.getenv("CHATBRAIN_DETECTOR_BACKEND", "torch"),
+        imgsz=int(os.getenv("CHATBRAIN_DETECTOR_IMGSZ", 640)),
+        int8=os.getenv("CHATBRAIN_DETECTOR_INT8", "0") == "1"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the chat bubble detector for a CPU runtime.")
+    parser.add_argument("--weights", default="backend/vision/best.pt")
+    parser.add_argument("--backend", choices=DETECTOR_BACKENDS[1:], default="onnx")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--data", default="backend/vision/chat_dataset.yaml", help="calibration dataset for OpenVINO INT8")
+    args = parser.parse_args()
+    print(f"Exported to {export_detector(args.weights, args.backend, args.imgsz, args.int8, args.data)}")
@@ -0,0 +1,104 @@
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from backend.vision import ocr
+
+# Reader owned by each worker process, loaded once by _init_worker
+_worker_reader = None
+
+def _init_worker(languages, torch_threads):
+    global _worker_reader
+    import torch
+    from easyocr import Reader
+    # each worker gets its share of the cores instead of one torch thread per core
+    torch.set_num_threads(torch_threads)
+    _worker_reader = Reader(languages, gpu=False)
+
+def _read_crops(crops, classes):
+    return [ocr.read_crop(crop, cls, _worker_reader) for crop, cls in zip(crops, classes)]
+
+def _read_image(image, boxes, batch_size):
+    return [box['text'] for box in ocr.extract_text_batched(image, boxes, _worker_reader, batch_size)]
+
+
+class OcrPool:
+    """
+    Reads bubbles on a pool of worker processes, each holding its own easyocr Reader.
+    With the "per_box" engine, the crops of an image are split into chunks spread over
+    the workers; with "batched", each image goes to one worker (CRAFT needs all of it).
+    Submitting every image of a request before collecting spreads them all over the pool.
+    """
+
+    def __init__(self, languages=['fr'], workers=4, torch_threads=1):
+        self.languages = languages
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # started lazily so the pool is only forked by the process that serves requests
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self.languages, self.torch_threads)
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, image, boxes, engine="per_box", batch_size=16):
+        """
+        Sends the pixels the boxes need to the workers and returns a handle for collect().
+        Crops are copied when sent, so `image` can be released right after.
+        """
+        if not boxes:
+            return []
+        image = ocr.as_bgr_array(image)
+        executor = self._get_executor()
+        if engine == "batched":
+            return [(list(range(len(boxes))), executor.submit(_read_image, image, boxes, batch_size))]
+        height, width = image.shape[:2]
+        readable, crops = [], []
+        for i, (x1, y1, x2, y2) in enumerate(ocr.box_pixels(boxes, width, height)):
+            if x2 > x1 and y2 > y1:
+                readable.append(i)
+                crops.append(image[y1:y2, x1:x2])
+        chunk = max(1, math.ceil(len(crops) / self.workers))
+        return [(readable[start:start + chunk],
+                 executor.submit(_read_crops, crops[start:start + chunk], [boxes[i]['cls'] for i in readable[start:start + chunk]]))
+                for start in range(0, len(crops), chunk)]
+
+    def collect(self, boxes, pending):
+        """Waits for a submit() handle and sets the 'text' of the boxes, in box order."""
+        for box in boxes:
+            box['text'] = ""
+        for indices, future in pending:
+            for i, text in zip(indices, future.result()):
+                boxes[i]['text'] = text
+        return boxes
+
+    def extract_text_from_boxes(self, image, boxes, engine="per_box", batch_size=16):
+        """Same as ocr.extract_text_from_boxes, on the pool."""
+        return self.collect(boxes, self.submit(image, boxes, engine, batch_size))
+
+    def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
+
+
+def from_env(languages=['fr']):
+    """
+    Builds the pool from CHATBRAIN_OCR_WORKERS (0, the default, reads in the serving process)
+    and CHATBRAIN_OCR_TORCH_THREADS (default: the cores divided between the workers).
+    Returns None when the pool is disabled.
+    """
+    workers = int(os.getenv("CHATBRAIN_OCR_WORKERS", 0))
+    if workers <= 0:
+        return None
+    torch_threads = int(os.getenv("CHATBRAIN_OCR_TORCH_THREADS", max(1, (os.cpu_count() or 1) // workers)))
+    return OcrPool(languages, workers, torch_threads)
@@ -0,0 +1,64 @@
+import contextvars
+import queue
+import threading
+from backend import profiling
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+def threaded(iterable, maxsize=2, batch=None, name="pipeline-stage"):
+    """
+    Consumes `iterable` in a background thread and yields its items, buffering at most
+    `maxsize` of them: chaining threaded generators runs every stage concurrently while
+    bounding the number of frames in flight. Exceptions of the stage are re-raised in
+    the consumer; if the consumer stops early, the stage stops at its next item.
+    With `batch`, yields lists of up to `batch` items: the next item, and whichever
+    were already buffered behind it.
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        profiling.register_thread()
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+
+    # the stage sees the context of the request that started it (metrics of the request)
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), name=name, daemon=True)
+    thread.start()
+    try:
+        done = False
+        while not done:
+            ready = [items.get()]
+            while batch and len(ready) < batch and not isinstance(ready[-1], _Failure) and ready[-1] is not _DONE:
+                try:
+                    ready.append(items.get_nowait())
+                except queue.Empty:
+                    break
+            if isinstance(ready[-1], _Failure):
+                raise ready[-1].error
+            if ready[-1] is _DONE:
+                done = True
+                ready.pop()
+            if ready:
+                yield ready if batch else ready[0]
+            ready = None  # don't keep the last frames alive while waiting for the next ones
+    finally:
+        stopped.set()
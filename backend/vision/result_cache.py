@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Bump when the format of the cached results changes
+RESULT_FORMAT = 1
+
+def model_version(model_path, languages, settings=()):
+    """
+    Identifies the detection model and OCR reader, so that results are not reused across models.
+    `settings` are the other options that change the results, e.g. the OCR engine or the detector backend.
+    """
+    digest = hashlib.sha256(f"{RESULT_FORMAT}|{','.join(languages)}|{','.join(settings)}|".encode())
+    if os.path.exists(model_path):
+        with open(model_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        digest.update(model_path.encode())
+    return digest.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Content-addressed cache of per-image detection + OCR results.
+    Entries are keyed on a hash of the decoded pixels and the model version, and
+    stored as JSON in two tiers: an in-memory LRU of `memory_items` entries, and
+    an on-disk directory capped at `disk_bytes` where the least recently used
+    files are evicted first.
+    """
+
+    def __init__(self, version, directory=None, memory_items=256, disk_bytes=256 * 1024 * 1024):
+        self.version = version
+        self.directory = directory
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._disk_size = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_size = sum(size for _, size, _ in self._disk_entries())
+
+    def key(self, image):
+        """Hash of a decoded image (numpy array) and the model version."""
+        digest = hashlib.sha256(f"{self.version}|{image.shape}|{image.dtype}|".encode())
+        digest.update(memoryview(image).cast("B") if image.flags.c_contiguous else image.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _disk_entries(self):
+        """Yields (path, size, mtime) for every file of the disk tier."""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """Returns a fresh copy of the cached result for `key`, or None."""
+        with self._lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return json.loads(data)
+        if self.directory:
+            path = self._path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = f.read()
+                os.utime(path)  # refresh for LRU eviction
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self.hits["disk"] += 1
+                    self._remember(key, data)
+                return json.loads(data)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        data = json.dumps(result)
+        with self._lock:
+            self._remember(key, data)
+        if self.directory:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_size += len(data.encode())
+                if self._disk_size > self.disk_bytes:
+                    self._evict_disk()
+
+    def _remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # rescan, as other processes may share the same directory
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_bytes * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._disk_size = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits["memory"] + self.hits["disk"] + self.misses
+            return {
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else None,
+                "memory_items": len(self.memory),
+                "disk_bytes": self._disk_size,
+                "disk_evictions": self.evictions
+            }
+
+
+def from_env(model_path, languages, settings=()):
+    """Builds the cache from the CHATBRAIN_CACHE_* environment variables. An empty CHATBRAIN_CACHE_DIR keeps it in memory only."""
+    return ResultCache(
+        model_version(model_path, languages, settings),
+        directory=os.getenv("CHATBRAIN_CACHE_DIR", ".cache/vision") or None,
+        memory_items=int(os.getenv("CHATBRAIN_CACHE_MEMORY_ITEMS", 256)),
+        disk_bytes=int(os.getenv("CHATBRAIN_CACHE_DISK_MB", 256)) * 1024 * 1024
+    )
@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+
+# Bubbles touching the top or bottom of a screenshot (within this fraction of its height) are cut off
+EDGE_MARGIN = 0.005
+# Shortest overlapping run: the spacing of a single bubble can't be checked, and one short
+# bubble ("ok", "lol") ending a screenshot often looks like the one starting the next
+MIN_RUN = 2
+
+def dhash(crop):
+    """64-bit difference hash of a BGR or greyscale crop."""
+    grey = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(grey, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+def fingerprint_bubbles(image, boxes):
+    """
+    Fingerprints the message bubbles (not the contact name) of one screenshot, top to bottom.
+    Geometry is in units of the image width, which doesn't change when the chat scrolls.
+    Returns dicts with the box index, hash, side, width, height, y center and whether the bubble is cut off.
+    """
+    height, width = image.shape[:2]
+    fingerprints = []
+    for i, box in enumerate(boxes):
+        if box['cls'] == 2:
+            continue
+        x, y, w, h = box['xywhn']
+        x1, x2 = max(0, int((x - w/2) * width)), min(width, int((x + w/2) * width))
+        y1, y2 = max(0, int((y - h/2) * height)), min(height, int((y + h/2) * height))
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            continue
+        fingerprints.append({
+            'index': i,
+            'hash': dhash(image[y1:y2, x1:x2]),
+            'side': box['posClass'],
+            'w': w,
+            'h': h * height / width,
+            'y': y * height / width,
+            'cut': y - h/2 < EDGE_MARGIN or y + h/2 > 1 - EDGE_MARGIN
+        })
+    fingerprints.sort(key=lambda f: f['y'])
+    return fingerprints
+
+def same_bubble(a, b, max_hamming=10, tolerance=0.03):
+    return (a['side'] == b['side']
+            and abs(a['w'] - b['w']) < tolerance
+            and abs(a['h'] - b['h']) < tolerance
+            and bin(a['hash'] ^ b['hash']).count("1") <= max_hamming)
+
+def find_overlap(previous, following, max_hamming=10, tolerance=0.03):
+    """
+    Finds the longest run of complete bubbles ending the previous screenshot that also
+    starts the following one, with the same spacing (scrolling only shifts them), of at least
+    MIN_RUN bubbles. Returns (previous fingerprints, following fingerprints) of the run, empty if none.
+    """
+    previous = [f for f in previous if not f['cut']]
+    following = [f for f in following if not f['cut']]
+    for k in range(min(len(previous), len(following)), MIN_RUN - 1, -1):
+        tail, head = previous[-k:], following[:k]
+        if not all(same_bubble(a, b, max_hamming, tolerance) for a, b in zip(tail, head)):
+            continue
+        shifts = [a['y'] - b['y'] for a, b in zip(tail, head)]
+        if max(shifts) - min(shifts) < tolerance:
+            return tail, head
+    return [], []
+
+def mark_overlap(previous, previous_result, following, following_result, max_hamming=10, tolerance=0.03):
+    """
+    Flags with 'duplicate': True the bubbles of a screenshot that were already visible
+    in the previous one, given both fingerprints: everything in the following screenshot
+    down to the overlapping run, and a bubble cut off at the bottom of the previous
+    screenshot (its complete copy is in the following one). Returns the number of flagged bubbles.
+    """
+    tail, head = find_overlap(previous, following, max_hamming, tolerance)
+    if not head:
+        return 0
+    flagged = 0
+    for f in following:
+        if f['y'] <= head[-1]['y']:
+            following_result['boxes'][f['index']]['duplicate'] = True
+            flagged += 1
+    for f in previous:
+        if f['cut'] and f['y'] > tail[-1]['y']:
+            previous_result['boxes'][f['index']]['duplicate'] = True
+            flagged += 1
+    return flagged
+
+def mark_duplicates(images, img_results, max_hamming=10, tolerance=0.03):
+    """mark_overlap over every pair of consecutive screenshots. Returns the number of flagged bubbles."""
+    fingerprints = [fingerprint_bubbles(image, result['boxes']) for image, result in zip(images, img_results)]
+    return sum(mark_overlap(fingerprints[n - 1], img_results[n - 1], fingerprints[n], img_results[n], max_hamming, tolerance)
+               for n in range(1, len(images)))